@@ -1,6 +1,12 @@
+import argparse
+import re
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urljoin
+
 import pandas as pd
 import requests
-from bs4 import BeautifulSoup
+from lxml import html
+from requests.adapters import HTTPAdapter
 
 list_url = """http://aptaapps.apta.org/ptcas/observationhours.aspx"""
 # too lazy to scrape
@@ -12,25 +18,147 @@ icon_to_requirement_type = {
     'apta/images/refs/ref4.gif': 'PT hours are not required or considered',
     'apta/images/refs/varies.png': 'Other'
 }
-
-res = requests.get(list_url)
-soup = BeautifulSoup(res.content, 'lxml')
-program_table = soup.find('table', {'id': "ContentPlaceHolder1_gvPTO"})
-program_rows = program_table.find_all('tr')
+GRID_ID = 'ContentPlaceHolder1_gvPTO'
+FIRST_PAGE = 'Page$1'
+# the grid's pager links are javascript postbacks of the grid's event target with an argument like Page$2
+PAGER_POSTBACK = re.compile(r"__doPostBack\('([^']+)','(Page\$\d+)'\)")
+PROGRAM_COLUMNS = ['program_name', 'minimum_hours', 'recommended_hours', 'requirement_type', 'detail_url']
+# detail page labels are prefixed, so they can't collide with the grid's columns (including detail_url)
+DETAIL_PREFIX = 'detail: '
 
 # doesn't quite work, because it drops requirement info
 # df = pd.read_html(str(program_table))[0]
 
 
+def _form_state(tree):
+    """
+    :return: a dict of the page's hidden form fields (__VIEWSTATE, __EVENTVALIDATION, etc.), which ASP.NET needs posted
+    back to serve another page of the grid
+    """
+    return {field.get('name'): field.get('value', '') for field in tree.xpath('//form//input[@type="hidden"][@name]')}
+
+
+def _pager_links(tree):
+    """
+    :return: a dict from each page argument the grid's pager links to (the current page isn't a link) to its event
+    target
+    """
+    hrefs = tree.xpath('//table[@id=$grid_id]//a/@href', grid_id=GRID_ID)
+    return {argument: target for target, argument in PAGER_POSTBACK.findall(' '.join(hrefs))}
+
+
+def _fetch_grid_page(session, url, form_state=None, target=None, argument=None):
+    """
+    :return: the parsed grid page, the first if no postback argument is given
+    """
+    if argument is None:
+        resp = session.get(url)
+    else:
+        resp = session.post(url, data=dict(form_state, __EVENTTARGET=target, __EVENTARGUMENT=argument))
+    resp.raise_for_status()
+    return html.fromstring(resp.content, base_url=url)
+
+
 def parse_program(row):
-    program_data = row.find_all('td')
-    program_name = program_data[1].contents[0]
-    minimum_hours = program_data[3].contents[0]
-    recommended_hours = program_data[4].contents[0]
-    requirement = icon_to_requirement_type[program_data[2].find('img')['src']]
+    """
+    :param row: a program row of the grid, as an lxml element
+    :return: a dict of the program's hours and requirements, and the url of its detail page if it links one
+    """
+    name_cell, requirement_cell, minimum_cell, recommended_cell = row.xpath('./td')[1:5]
+    detail_hrefs = [href for href in name_cell.xpath('.//a/@href') if not href.startswith('javascript:')]
+
+    return {
+        'program_name': name_cell.text_content().strip(),
+        'minimum_hours': minimum_cell.text_content().strip(),
+        'recommended_hours': recommended_cell.text_content().strip(),
+        'requirement_type': icon_to_requirement_type[requirement_cell.xpath('.//img/@src')[0]],
+        'detail_url': urljoin(row.base_url, detail_hrefs[0]) if detail_hrefs else None,
+    }
+
+
+def parse_programs(tree):
+    # program rows are those with a requirement icon, which leaves out the header and pager rows
+    return [parse_program(row) for row in tree.xpath('//table[@id=$grid_id]//tr[td[3]//img]', grid_id=GRID_ID)]
+
+
+def parse_program_details(tree):
+    """
+    :return: a dict of the labelled values on a program detail page, i.e. two cell table rows and definition lists,
+    keyed by DETAIL_PREFIX and the label
+    """
+    details = {}
+    for row in tree.xpath('//tr[count(th | td) = 2]'):
+        label, value = [cell.text_content().strip() for cell in row.xpath('./th | ./td')]
+        if label:
+            details[DETAIL_PREFIX + label.rstrip(':').strip()] = value
+    for term in tree.xpath('//dl/dt[following-sibling::dd]'):
+        details[DETAIL_PREFIX + term.text_content().strip().rstrip(':').strip()] = \
+            term.xpath('following-sibling::dd[1]')[0].text_content().strip()
+
+    return details
+
+
+def _fetch_program_details(session, url):
+    resp = session.get(url)
+    resp.raise_for_status()
+    return parse_program_details(html.fromstring(resp.content, base_url=url))
+
+
+def scrape_programs(url=list_url, concurrency=8, details=True):
+    """
+    fetches every page of the program grid and, optionally, each program's detail page, concurrently over one pooled
+    session. pages are discovered through the pager, each posted back with the form state of the page linking it
+
+    :return: a list of program dicts, in grid order
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    page_to_programs = {}
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            requested_pages = {FIRST_PAGE}
+            pending = {executor.submit(_fetch_grid_page, session, url): FIRST_PAGE}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    tree = future.result()
+                    page_to_programs[pending.pop(future)] = parse_programs(tree)
+
+                    form_state = _form_state(tree)
+                    for argument, target in _pager_links(tree).items():
+                        if argument not in requested_pages:
+                            requested_pages.add(argument)
+                            pending[executor.submit(_fetch_grid_page, session, url, form_state, target,
+                                                    argument)] = argument
+
+            programs = [program for page in sorted(page_to_programs, key=lambda argument: int(argument.split('$')[1]))
+                        for program in page_to_programs[page]]
+
+            if details:
+                detail_futures = [(program, executor.submit(_fetch_program_details, session, program['detail_url']))
+                                  for program in programs if program['detail_url']]
+                for program, future in detail_futures:
+                    program.update(future.result())
+    finally:
+        session.close()
+
+    return programs
+
 
-    return program_name, minimum_hours, recommended_hours, requirement
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scrapes the observation hours PTCAS programs require')
+    parser.add_argument('--list-url', default=list_url,
+                        help='the program grid, e.g. saved pages served locally for testing')
+    parser.add_argument('--output', default='/Users/kholub/ptcas_obs_hours.csv')
+    parser.add_argument('--concurrency', type=int, default=8, help='the number of pages fetched at once')
+    parser.add_argument('--no-details', action='store_true', help="skip fetching each program's detail page")
+    args = parser.parse_args()
 
-parsed_programs = [parse_program(r) for r in program_rows[2:]]
-df = pd.DataFrame(parsed_programs, columns=['program_name', 'minimum_hours', 'recommended_hours', 'requirement_type'])
-df.to_csv('/Users/kholub/ptcas_obs_hours.csv')
+    programs = scrape_programs(args.list_url, args.concurrency, not args.no_details)
+    # detail columns follow the grid's, in a fixed order however the detail pages happen to be laid out
+    detail_columns = sorted({key for program in programs for key in program if key.startswith(DETAIL_PREFIX)})
+    df = pd.DataFrame(programs, columns=PROGRAM_COLUMNS + detail_columns)
+    df.to_csv(args.output)
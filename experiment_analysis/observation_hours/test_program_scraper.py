@@ -0,0 +1,73 @@
+import os
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from program_scraper import DETAIL_PREFIX, scrape_programs
+
+TEST_DATA = os.path.join(os.path.dirname(__file__), 'test_data')
+LIST_PATH = '/observationhours.aspx'
+
+
+class _GridHandler(SimpleHTTPRequestHandler):
+    """
+    serves the saved pages as the grid would: its first page on a GET of LIST_PATH, another on a postback of its page
+    argument with the form state, and the detail pages as static files
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, directory=TEST_DATA, **kwargs)
+
+    def do_GET(self):
+        if self.path == LIST_PATH:
+            self.path = '/grid_page_1.html'
+        super().do_GET()
+
+    def do_POST(self):
+        form = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        page = form['__EVENTARGUMENT'][0].split('$')[1]
+        if self.path != LIST_PATH or form.get('__VIEWSTATE', [''])[0] == '' or \
+                form['__EVENTTARGET'] != ['ctl00$ContentPlaceHolder1$gvPTO']:
+            self.send_error(400)
+            return
+        self.path = '/grid_page_%s.html' % page
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _scrape(details):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _GridHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        return scrape_programs('http://127.0.0.1:%d%s' % (server.server_address[1], LIST_PATH), concurrency=4,
+                               details=details)
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+
+def test_programs_are_in_grid_order():
+    programs = _scrape(details=False)
+
+    assert [program['program_name'] for program in programs] == \
+        ['Alpha University', 'Beta College', 'Gamma Institute', 'Delta State University', 'Epsilon University']
+    assert programs[2]['requirement_type'] == 'PT hours are required - no verification by a physical therapist'
+    assert programs[0]['detail_url'].endswith('/program_alpha.html')
+    assert programs[1]['detail_url'] is None
+
+
+def test_details_do_not_overwrite_grid_fields():
+    programs = _scrape(details=True)
+
+    alpha, beta, gamma = programs[:3]
+    assert alpha['program_name'] == 'Alpha University'
+    assert alpha['minimum_hours'] == '40'
+    assert alpha[DETAIL_PREFIX + 'Program Name'] == 'Alpha University Doctor of Physical Therapy'
+    assert alpha[DETAIL_PREFIX + 'Minimum Hours'] == '40 hours, in at least two settings'
+    assert alpha[DETAIL_PREFIX + 'Verification'] == 'Online via PTCAS'
+    assert gamma['detail_url'].endswith('/program_gamma.html')
+    assert gamma[DETAIL_PREFIX + 'Url'] == 'http://www.gamma.example/dpt'
+    assert not [key for key in beta if key.startswith(DETAIL_PREFIX)]
@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 import requests
 from sklearn.feature_extraction.text import CountVectorizer
@@ -8,33 +9,62 @@ import lxml.builder
 import binascii
 import os
 import traceback
+from functools import lru_cache
 
 data = pd.read_excel('./Students Excel (Qualitative).xlsx')
 stemmer = nltk.stem.SnowballStemmer('english')
+# the number of most frequent phrases reported for each n and column
+TOP_PHRASES = 250
+# the number of distinct words whose stems are memoized. responses reuse a small vocabulary, so most stems are hits
+STEM_CACHE_SIZE = 2 ** 16
 
 
 class StemmedCountVectorizer(CountVectorizer):
+    # a class attribute rather than a constructor parameter so sklearn's get_params and clone are unaffected. only
+    # one instance is built below, so the memo pays off on words repeated across responses, not across instances
+    stem = staticmethod(lru_cache(maxsize=STEM_CACHE_SIZE)(stemmer.stem))
 
     def build_analyzer(self):
         analyzer = super(StemmedCountVectorizer, self).build_analyzer()
-        return lambda doc: ([stemmer.stem(w) for w in analyzer(doc)])
+        stem = self.stem
+        return lambda doc: list(map(stem, analyzer(doc)))
 
 
+def _ngram_analyzer(n):
+    """
+    :return: an analyzer of already tokenized responses, joining each n consecutive tokens into a phrase
+    """
+    return lambda tokens: [' '.join(tokens[i:i + n]) for i in range(len(tokens) - n + 1)]
+
+
+# stemming dominates, so each column's responses are stemmed and tokenized once and reused for every n
+unigram_analyzer = StemmedCountVectorizer(analyzer="word", stop_words=stopwords.words('english')).build_analyzer()
+column_to_text = {col: data[~pd.isnull(data[col])][col] for col in data.columns}
+column_to_tokens = {col: [unigram_analyzer(response) for response in analyzable_text]
+                    for col, analyzable_text in column_to_text.items()}
+
 for n in [1, 2, 3, 4]:
     writer = pd.ExcelWriter(f'./outputs/response_{n}-grams.xlsx', engine='xlsxwriter')
     for col in data.columns:
-        vectorizer = StemmedCountVectorizer(ngram_range=[n, n], min_df=.01, analyzer="word", stop_words=stopwords.words('english'))
-        analyzable_text = data[~pd.isnull(data[col])][col]
+        vectorizer = CountVectorizer(analyzer=_ngram_analyzer(n), min_df=.01)
+        analyzable_text = column_to_text[col]
         try:
-            freqs = vectorizer.fit_transform(analyzable_text).todense().sum(axis=0)
+            # summing the sparse counts avoids densifying a response x phrase matrix
+            freqs = vectorizer.fit_transform(column_to_tokens[col]).sum(axis=0).A1
         except: # general, to catch no words remaining after min_df pruning
             continue
-        features = vectorizer.get_feature_names()
+        features = np.array(vectorizer.get_feature_names(), dtype=object)
+        # rather than sorting every phrase, only those counted at least as often as the TOP_PHRASES-th are sorted, by
+        # count then phrase. every phrase tied at that count is kept until the cut, so which make it isn't arbitrary
+        threshold = np.partition(freqs, len(freqs) - TOP_PHRASES)[len(freqs) - TOP_PHRASES] \
+            if len(freqs) > TOP_PHRASES else 0
+        top = np.flatnonzero(freqs >= threshold)
+        top = top[np.lexsort((features[top], -freqs[top]))][:TOP_PHRASES]
         freq_column = f'count ({len(analyzable_text)} total responses)'
         freq_df = pd.DataFrame({
-            'phrase': features,
-            freq_column: freqs.tolist()[0]
-        }).sort_values(freq_column, ascending=False).head(250)
+            'phrase': features[top],
+            freq_column: freqs[top]
+        })
         freq_df.to_excel(writer, sheet_name=col[0:31], index=False)
 
     writer.save()
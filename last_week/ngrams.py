@@ -0,0 +1,542 @@
+import heapq
+import json
+import math
+import os
+import re
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice, repeat
+from operator import and_, lshift, or_, rshift
+
+import nltk
+import numpy as np
+
+# bits given to each token id when packing an n-gram into an integer key, allowing a vocabulary of ~16M tokens
+TOKEN_BITS = 24
+TOKEN_MASK = (1 << TOKEN_BITS) - 1
+# the number of tokens held in memory at once while counting
+CHUNK_SIZE = 1 << 16
+# token ids are stored big endian in an index, so comparing the raw bytes of two n-grams orders them token by token
+INDEX_ID_DTYPE = np.dtype('>u4')
+INDEX_METADATA_FILE = 'metadata.json'
+# a line ending each transcript in a transcripts file, since transcripts themselves contain blank lines
+TRANSCRIPT_SEPARATOR = '\f\n'
+# regular expressions for text that isn't part of the show: the download limit banner and audience reactions
+NOISE_PATTERNS = [
+    re.escape("You can't download more then 50 subtitles per day!"),
+    re.escape("(AUDIENCE LAUGHS)"),
+    re.escape("(AUDIENCE LAUGHING)"),
+]
+
+
+class SpaceSaving:
+    """
+    approximate counts of the most frequent keys in a stream, in memory fixed by capacity (Metwally et al.'s
+    Space-Saving). once capacity keys are monitored, a new key replaces the one with the lowest count and inherits that
+    count as its error. a key's count is never underestimated, and is overestimated by at most N / capacity over a
+    stream of N keys, so any key occurring more than N / capacity times is guaranteed to be monitored
+    """
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._counts = {}
+        self._errors = {}
+        # a min heap with one (count, key) entry per monitored key. counts are only increased in place, so an entry
+        # may lag behind its key's count, in which case it is refreshed when it reaches the top
+        self._heap = []
+        self._total = 0
+
+    def _evict_minimum(self):
+        """
+        :return: the lowest count of any monitored key, after removing that key
+        """
+        while True:
+            count, key = self._heap[0]
+            if self._counts[key] == count:
+                heapq.heappop(self._heap)
+                del self._counts[key]
+                del self._errors[key]
+                return count
+            heapq.heapreplace(self._heap, (self._counts[key], key))
+
+    def update(self, keys):
+        counts = self._counts
+        for key in keys:
+            self._total += 1
+            if key in counts:
+                counts[key] += 1
+            elif len(counts) < self._capacity:
+                counts[key] = 1
+                self._errors[key] = 0
+                heapq.heappush(self._heap, (1, key))
+            else:
+                minimum_count = self._evict_minimum()
+                counts[key] = minimum_count + 1
+                self._errors[key] = minimum_count
+                heapq.heappush(self._heap, (minimum_count + 1, key))
+
+    def __getitem__(self, key):
+        """
+        :return: the count of key. a key not monitored may have occurred as often as the lowest monitored count, so
+        that is its count (it is 0 until the summary is full, since then every key seen is monitored)
+        """
+        return self._counts[key] if key in self._counts else self._minimum()
+
+    def __iter__(self):
+        return iter(self._counts)
+
+    def __len__(self):
+        return len(self._counts)
+
+    def error(self, key):
+        """
+        :return: the most the count of key may be overestimated by
+        """
+        return self._errors.get(key, self._minimum())
+
+    def error_bound(self):
+        return self._total / self._capacity
+
+    def items(self):
+        return self._counts.items()
+
+    def values(self):
+        return self._counts.values()
+
+    def most_common(self, k):
+        return heapq.nlargest(k, self._counts.items(), key=lambda kv: kv[1])
+
+    def _minimum(self):
+        """
+        :return: the most times a key not monitored may have occurred
+        """
+        if len(self._counts) < self._capacity:
+            return 0
+        # refresh lagging heap entries until the top is current, at which point it's the lowest count
+        while True:
+            count, key = self._heap[0]
+            if self._counts[key] == count:
+                return count
+            heapq.heapreplace(self._heap, (self._counts[key], key))
+
+    def merge(self, other, remap_key=None):
+        """
+        adds the counts of another summary (of the same capacity) into this one, following Agarwal et al.'s mergeable
+        summaries. a key monitored by only one summary is taken to have occurred as often as the other's minimum count,
+        so counts remain upper bounds, overestimated by at most the combined N / capacity
+
+        :param remap_key: a function translating the other summary's keys into this one's
+        """
+        self_minimum = self._minimum()
+        other_minimum = other._minimum()
+        other_counts = {}
+        other_errors = {}
+        for key, count in other._counts.items():
+            remapped_key = remap_key(key) if remap_key else key
+            other_counts[remapped_key] = count
+            other_errors[remapped_key] = other._errors[key]
+
+        merged = [(key,
+                   self._counts.get(key, self_minimum) + other_counts.get(key, other_minimum),
+                   self._errors.get(key, self_minimum) + other_errors.get(key, other_minimum))
+                  for key in self._counts.keys() | other_counts.keys()]
+        kept = heapq.nlargest(self._capacity, merged, key=lambda merged_key: merged_key[1])
+
+        self._counts = {key: count for key, count, _ in kept}
+        self._errors = {key: error for key, _, error in kept}
+        self._heap = [(count, key) for key, count in self._counts.items()]
+        heapq.heapify(self._heap)
+        self._total += other._total
+
+
+class NgramCounter:
+    """
+    counts n-grams of several orders in a single pass over a token stream. tokens are interned to integer ids, and
+    each n-gram is packed into one integer key with the most recent token in the lowest bits
+    """
+    def __init__(self, orders=range(2, 7), epsilon=None):
+        """
+        :param epsilon: if given, count each order approximately with SpaceSaving, in memory of 1 / epsilon n-grams per
+        order, overestimating counts by at most epsilon times the number of n-grams seen. otherwise counts are exact
+        """
+        self._orders = sorted(orders)
+        self._epsilon = epsilon
+        self._token_to_id = {}
+        self._tokens = []
+        if epsilon is None:
+            self._order_to_counts = {order: Counter() for order in self._orders}
+        else:
+            self._order_to_counts = {order: SpaceSaving(math.ceil(1 / epsilon)) for order in self._orders}
+
+    def _intern_all(self, tokens):
+        """
+        :return: a list of the ids of tokens, assigning ids to any not seen before
+        """
+        token_to_id = self._token_to_id
+        new_tokens = [token for token in dict.fromkeys(tokens) if token not in token_to_id]
+        if len(self._tokens) + len(new_tokens) > TOKEN_MASK + 1:
+            raise ValueError('Vocabulary exceeds the %d token ids packable in %d bits' % (TOKEN_MASK + 1, TOKEN_BITS))
+        token_to_id.update(zip(new_tokens, range(len(self._tokens), len(self._tokens) + len(new_tokens))))
+        self._tokens.extend(new_tokens)
+
+        return list(map(token_to_id.__getitem__, tokens))
+
+    def update(self, tokens, chunk_size=CHUNK_SIZE):
+        """
+        :param tokens: an iterable of tokens, consumed once, chunk_size tokens at a time. n-grams are not counted across
+        separate updates
+        """
+        max_order = self._orders[-1]
+        tokens = iter(tokens)
+        # the ids of the last max_order - 1 tokens of the previous chunk, so n-grams spanning chunks are counted
+        carried_ids = []
+        while True:
+            chunk = list(islice(tokens, chunk_size))
+            if not chunk:
+                break
+
+            ids = carried_ids + self._intern_all(chunk)
+            keys = ids
+            for order in range(1, max_order + 1):
+                if order > 1:
+                    # extend each order - 1 key with the token following it. map stops at the shorter iterable, so
+                    # the last key (which has no following token) is dropped
+                    keys = list(map(or_, map(lshift, keys, repeat(TOKEN_BITS)), islice(ids, order - 1, None)))
+                if order in self._order_to_counts:
+                    # skip n-grams lying entirely within the carried ids, since the previous chunk counted them
+                    self._order_to_counts[order].update(islice(keys, max(0, len(carried_ids) - order + 1), None))
+
+            carried_ids = ids[-(max_order - 1):] if max_order > 1 else []
+
+    def _unpack(self, key, order):
+        return tuple(self._tokens[(key >> (TOKEN_BITS * position)) & TOKEN_MASK]
+                     for position in reversed(range(order)))
+
+    def most_common(self, order, k):
+        """
+        :return: a list of (n-gram tuple, count) for the k most frequent n-grams of the order, most frequent first.
+        n-grams with equal counts are ordered by their tokens, so the result does not depend on the order of counting
+        """
+        counts = self._order_to_counts[order]
+        if k <= 0:
+            return []
+        # the kth largest count is found with a heap rather than sorting everything, leaving only ties to decode
+        threshold = heapq.nlargest(k, counts.values())[-1] if len(counts) > k else 0
+        candidates = [(self._unpack(key, order), count) for key, count in counts.items() if count >= threshold]
+
+        return sorted(candidates, key=lambda ngram_count: (-ngram_count[1], ngram_count[0]))[:k]
+
+    def merge(self, other):
+        """
+        adds the counts of another NgramCounter, with the same orders and epsilon, into this one. token ids are
+        assigned independently by each counter, so the other's keys are translated into this counter's ids
+        """
+        id_map = self._intern_all(other._tokens)
+        if id_map == list(range(len(id_map))):
+            for order in self._orders:
+                self._merge_order(order, other._order_to_counts[order], None)
+            return
+
+        def remap_key(key, order):
+            remapped_key = 0
+            for position in reversed(range(order)):
+                remapped_key = (remapped_key << TOKEN_BITS) | id_map[(key >> (TOKEN_BITS * position)) & TOKEN_MASK]
+            return remapped_key
+
+        # key -> remapped key for the previous order. every n-gram's leading n - 1 tokens were themselves counted as an
+        # n - 1 gram, so when exactly counting consecutive orders each key is remapped from its remapped prefix
+        previous_order, previous_remapped_keys = 1, id_map
+        for order in self._orders:
+            other_counts = other._order_to_counts[order]
+            if order == 1:
+                remapped_keys = dict(zip(other_counts, map(id_map.__getitem__, other_counts)))
+            elif self._epsilon is None and previous_order == order - 1:
+                remapped_prefixes = map(previous_remapped_keys.__getitem__,
+                                        map(rshift, other_counts, repeat(TOKEN_BITS)))
+                remapped_last_tokens = map(id_map.__getitem__, map(and_, other_counts, repeat(TOKEN_MASK)))
+                remapped_keys = dict(zip(other_counts, map(or_, map(lshift, remapped_prefixes, repeat(TOKEN_BITS)),
+                                                           remapped_last_tokens)))
+            else:
+                remapped_keys = {key: remap_key(key, order) for key in other_counts}
+
+            self._merge_order(order, other_counts, remapped_keys)
+            previous_order, previous_remapped_keys = order, remapped_keys
+
+    def _merge_order(self, order, other_counts, remapped_keys):
+        """
+        :param remapped_keys: a dict from each of other_counts' keys to this counter's key, or None if they are the same
+        """
+        counts = self._order_to_counts[order]
+        if self._epsilon is None:
+            counts.update(other_counts if remapped_keys is None else
+                          dict(zip(remapped_keys.values(), other_counts.values())))
+        else:
+            counts.merge(other_counts, None if remapped_keys is None else remapped_keys.__getitem__)
+
+    def error_bound(self, order):
+        """
+        :return: the most any count of the order may be overestimated by
+        """
+        if self._epsilon is None:
+            return 0
+        return self._order_to_counts[order].error_bound()
+
+    def count(self, ngram):
+        """
+        :return: the number of times the n-gram tuple was seen (an upper bound on it, when counting approximately)
+        """
+        key = 0
+        for token in ngram:
+            token_id = self._token_to_id.get(token)
+            if token_id is None:
+                return 0
+            key = (key << TOKEN_BITS) | token_id
+
+        return self._order_to_counts[len(ngram)][key]
+
+    def _untracked_count(self, order):
+        """
+        :return: the count of any n-gram of the order that isn't tracked, i.e. 0 when counting exactly
+        """
+        if self._epsilon is None:
+            return 0
+        return self._order_to_counts[order]._minimum()
+
+    def write_index(self, directory):
+        """
+        persists the counts to the directory, to be queried with NgramIndex. each order is stored as its n-grams'
+        token id rows, sorted lexicographically, and a parallel array of counts
+        """
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, INDEX_METADATA_FILE), 'w') as f:
+            json.dump({'tokens': self._tokens,
+                       'orders': self._orders,
+                       'error_bounds': [self.error_bound(order) for order in self._orders],
+                       'untracked_counts': [self._untracked_count(order) for order in self._orders]}, f)
+
+        for order in self._orders:
+            counts = self._order_to_counts[order]
+            keys = list(counts)
+            rows = np.empty((len(keys), order), dtype=INDEX_ID_DTYPE)
+            for position in range(order):
+                shift = TOKEN_BITS * (order - 1 - position)
+                rows[:, position] = np.fromiter(map(and_, map(rshift, keys, repeat(shift)), repeat(TOKEN_MASK)),
+                                                dtype=np.uint32, count=len(keys))
+            count_array = np.fromiter(map(counts.__getitem__, keys), dtype=np.int64, count=len(keys))
+
+            sort_order = np.argsort(_as_index_keys(rows), kind='stable')
+            np.save(os.path.join(directory, 'order_%d_keys.npy' % order), rows[sort_order])
+            np.save(os.path.join(directory, 'order_%d_counts.npy' % order), count_array[sort_order])
+
+
+def _as_index_keys(rows):
+    """
+    :param rows: an (n-grams, order) array of big endian token ids
+    :return: a 1d view of the rows as opaque byte strings, which numpy sorts and searches by comparing bytes
+    """
+    return np.ascontiguousarray(rows).view(np.dtype((np.void, rows.shape[1] * INDEX_ID_DTYPE.itemsize))).reshape(-1)
+
+
+class NgramIndex:
+    """
+    read only n-gram counts written by NgramCounter.write_index. the sorted keys and counts are memory mapped, so
+    opening an index is cheap and a query only reads the pages its binary search touches
+    """
+    def __init__(self, directory):
+        with open(os.path.join(directory, INDEX_METADATA_FILE), 'r') as f:
+            metadata = json.load(f)
+        self._tokens = metadata['tokens']
+        self._token_to_id = {token: token_id for token_id, token in enumerate(self._tokens)}
+        self._order_to_error_bound = dict(zip(metadata['orders'], metadata['error_bounds']))
+        # n-grams missing from an approximate index may have occurred as often as its smallest stored count
+        self._order_to_untracked_count = dict(zip(metadata['orders'], metadata['untracked_counts']))
+
+        self._order_to_rows = {}
+        self._order_to_keys = {}
+        self._order_to_counts = {}
+        for order in metadata['orders']:
+            rows = np.load(os.path.join(directory, 'order_%d_keys.npy' % order), mmap_mode='r')
+            self._order_to_rows[order] = rows
+            self._order_to_keys[order] = _as_index_keys(rows)
+            self._order_to_counts[order] = np.load(os.path.join(directory, 'order_%d_counts.npy' % order),
+                                                   mmap_mode='r')
+
+    def _check_order(self, order):
+        if order not in self._order_to_counts:
+            raise ValueError('Order %d is not indexed, only orders %s are' % (order, sorted(self._order_to_counts)))
+
+    def _ids(self, tokens):
+        """
+        :return: a list of the ids of tokens, or None if any was never seen
+        """
+        ids = [self._token_to_id.get(token) for token in tokens]
+        return None if None in ids else ids
+
+    def _range(self, order, low_ids, high_ids):
+        """
+        :return: the start and end positions of the order's n-grams between the two id lists, inclusive
+        """
+        keys = self._order_to_keys[order]
+        low = _as_index_keys(np.array([low_ids], dtype=INDEX_ID_DTYPE))
+        high = _as_index_keys(np.array([high_ids], dtype=INDEX_ID_DTYPE))
+        return int(np.searchsorted(keys, low, 'left')[0]), int(np.searchsorted(keys, high, 'right')[0])
+
+    def count(self, ngram):
+        """
+        :return: the number of times the n-gram tuple was seen (an upper bound on it, when counted approximately)
+        :raises ValueError: if the n-gram's length isn't an indexed order
+        """
+        self._check_order(len(ngram))
+        ids = self._ids(ngram)
+        if ids is None:
+            return 0
+        start, end = self._range(len(ngram), ids, ids)
+
+        return int(self._order_to_counts[len(ngram)][start]) if end > start else \
+            self._order_to_untracked_count[len(ngram)]
+
+    def continuations(self, prefix, k=10):
+        """
+        :param prefix: a tuple of tokens, one shorter than an indexed order
+        :return: a list of (token, count) for the k most frequent tokens following the prefix, most frequent first.
+        tokens with equal counts are ordered alphabetically
+        :raises ValueError: if the prefix isn't one shorter than an indexed order
+        """
+        order = len(prefix) + 1
+        self._check_order(order)
+        ids = self._ids(prefix)
+        if ids is None or k <= 0:
+            return []
+        start, end = self._range(order, ids + [0], ids + [TOKEN_MASK])
+        counts = np.asarray(self._order_to_counts[order][start:end])
+
+        # the kth largest count is found by partitioning rather than sorting, leaving only ties to order
+        threshold = np.partition(counts, len(counts) - k)[len(counts) - k] if len(counts) > k else 0
+        candidates = np.flatnonzero(counts >= threshold)
+        last_ids = self._order_to_rows[order][start + candidates, -1]
+        continuations = [(self._tokens[token_id], int(count))
+                         for token_id, count in zip(last_ids.tolist(), counts[candidates].tolist())]
+
+        return sorted(continuations, key=lambda token_count: (-token_count[1], token_count[0]))[:k]
+
+    def error_bound(self, order):
+        """
+        :return: the most any count of the order may be overestimated by
+        """
+        self._check_order(order)
+        return self._order_to_error_bound[order]
+
+
+def compile_noise(noise_patterns=NOISE_PATTERNS):
+    """
+    :return: a single regular expression matching any of the noise patterns, so text is cleaned in one pass
+    """
+    return re.compile('|'.join('(?:%s)' % pattern for pattern in noise_patterns))
+
+
+def clean_tokens(lines, noise=None, tokenize=nltk.word_tokenize):
+    """
+    :param lines: an iterable of text, e.g. an open file, consumed lazily
+    :param noise: a compiled regular expression of text to remove, defaulting to NOISE_PATTERNS
+    :return: a generator of the tokens of each line, once noise is removed
+    """
+    noise = noise or compile_noise()
+    for line in lines:
+        yield from tokenize(noise.sub('', line))
+
+
+def write_transcripts(transcripts, path):
+    """
+    writes transcripts to a file, each followed by a TRANSCRIPT_SEPARATOR line, so read_transcripts recovers them
+    """
+    with open(path, 'w') as f:
+        for transcript in transcripts:
+            f.write(transcript.rstrip('\n') + '\n' + TRANSCRIPT_SEPARATOR)
+
+
+def _lines_until_separator(line, lines):
+    """
+    :return: a generator of line and the following lines, up to the next TRANSCRIPT_SEPARATOR or the end of lines
+    """
+    while line != TRANSCRIPT_SEPARATOR:
+        yield line
+        line = next(lines, TRANSCRIPT_SEPARATOR)
+
+
+def _transcripts_lines(f):
+    """
+    :return: a generator of a generator of lines for each transcript in the open file, so no transcript is held in
+    memory whole. lines of a transcript not consumed before moving on to the next are skipped
+    """
+    lines = iter(f)
+    for line in lines:
+        transcript_lines = _lines_until_separator(line, lines)
+        yield transcript_lines
+        for _ in transcript_lines:
+            pass
+
+
+def read_transcripts(path):
+    """
+    :return: a generator of the transcripts of a file written by write_transcripts. a file without separators (e.g.
+    ./all_transcripts.txt) is a single transcript
+    """
+    with open(path, 'r') as f:
+        for lines in _transcripts_lines(f):
+            yield ''.join(lines)
+
+
+def count_file(path, orders=range(2, 7), epsilon=None, noise_patterns=NOISE_PATTERNS, tokenize=nltk.word_tokenize,
+               processes=1):
+    """
+    counts a transcripts file as count_transcripts counts its transcripts, so no n-gram spans two transcripts and the
+    counts are the same however the corpus was loaded. serially, the file is streamed a line at a time, so memory stays
+    bounded even for a file that is one long transcript. with several processes, the transcripts are read into memory
+    and counted by count_transcripts
+
+    :return: an NgramCounter of the file
+    """
+    if processes != 1:
+        return count_transcripts(read_transcripts(path), orders, epsilon, noise_patterns, tokenize, processes)
+
+    noise = compile_noise(noise_patterns)
+    ngram_counter = NgramCounter(orders, epsilon)
+    with open(path, 'r') as f:
+        for lines in _transcripts_lines(f):
+            ngram_counter.update(clean_tokens(lines, noise, tokenize))
+
+    return ngram_counter
+
+
+def _count_batch(transcripts, orders, epsilon, noise_patterns, tokenize):
+    noise = compile_noise(noise_patterns)
+    ngram_counter = NgramCounter(orders, epsilon)
+    for transcript in transcripts:
+        ngram_counter.update(clean_tokens(transcript.splitlines(), noise, tokenize))
+
+    return ngram_counter
+
+
+def count_transcripts(transcripts, orders=range(2, 7), epsilon=None, noise_patterns=NOISE_PATTERNS,
+                      tokenize=nltk.word_tokenize, processes=1, batches_per_process=4):
+    """
+    cleans, tokenizes and counts each transcript separately, so no n-gram spans two transcripts. with several
+    processes, the transcripts are split into contiguous batches that workers count into their own NgramCounter, which
+    are then merged. exact counts are identical however many processes are used
+
+    :param tokenize: a picklable function splitting a line of a transcript into tokens
+    :return: an NgramCounter of all transcripts
+    """
+    transcripts = list(transcripts)
+    if processes == 1:
+        return _count_batch(transcripts, orders, epsilon, noise_patterns, tokenize)
+
+    batch_size = max(1, math.ceil(len(transcripts) / (processes * batches_per_process)))
+    batches = [transcripts[start:start + batch_size] for start in range(0, len(transcripts), batch_size)]
+
+    ngram_counter = NgramCounter(orders, epsilon)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for partial_counter in executor.map(_count_batch, batches, repeat(orders), repeat(epsilon),
+                                            repeat(noise_patterns), repeat(tokenize)):
+            ngram_counter.merge(partial_counter)
+
+    return ngram_counter
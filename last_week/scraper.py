@@ -1,89 +1,281 @@
+import argparse
+import os
+import sqlite3
+import threading
 import time
-from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urljoin
 
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
-import nltk
+
+from ngrams import count_file, count_transcripts, write_transcripts
 
 HOST = """https://www.yousubtitles.com"""
-BASE_PAGE = """https://www.yousubtitles.com/LastWeekTonight-cd-1453/%s"""
+LISTING_PATH = """/LastWeekTonight-cd-1453/%s"""
 # yousubtitles implements access "control" via UA, so we spoof one
 HEADERS = {'User-Agent': 'curl/7.54.0'}
+# responses worth retrying, since they indicate the server (or its rate limiting) rather than the request is the problem
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# served in place of a transcript once the daily download limit is hit
+DOWNLOAD_LIMIT_BANNER = "You can't download more then 50 subtitles per day!"
+
+
+class TokenBucket:
+    """
+    a thread safe rate limiter, allowing rate acquisitions per second on average with bursts of up to capacity
+    """
+    def __init__(self, rate, capacity=1):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._last_refill) * self._rate)
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_seconds = (1 - self._tokens) / self._rate
+            time.sleep(wait_seconds)
+
+
+class Fetcher:
+    """
+    makes rate limited GET requests over a single keep-alive session, retrying failures with exponential backoff
+    """
+    def __init__(self, concurrency=8, requests_per_second=2, retries=3, backoff_seconds=1, timeout_seconds=30):
+        self._session = requests.Session()
+        self._session.headers.update(HEADERS)
+        adapter = HTTPAdapter(pool_maxsize=concurrency)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+        self._rate_limiter = TokenBucket(requests_per_second)
+        self._retries = retries
+        self._backoff_seconds = backoff_seconds
+        self._timeout_seconds = timeout_seconds
+
+    def get(self, url, headers=None):
+        for attempt in range(self._retries + 1):
+            self._rate_limiter.acquire()
+            try:
+                resp = self._session.get(url, headers=headers, timeout=self._timeout_seconds)
+                if resp.status_code not in RETRY_STATUSES or attempt == self._retries:
+                    return resp
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self._retries:
+                    raise
+            time.sleep(self._backoff_seconds * 2 ** attempt)
+
+    def close(self):
+        self._session.close()
+
+
+class TranscriptCache:
+    """
+    an sqlite store of every title page seen and its transcript. each transcript is committed as it arrives, so an
+    interrupted crawl resumes from where it stopped
+    """
+    def __init__(self, path):
+        self._connection = sqlite3.connect(path)
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS titles (
+                url TEXT PRIMARY KEY,
+                download_url TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                text TEXT,
+                fetched_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS crawl_state (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+
+    def is_listing_complete(self):
+        """
+        :return: True if a previous crawl paginated through every title page, meaning any title not on the leading
+        pages is already known
+        """
+        row = self._connection.execute("SELECT value FROM crawl_state WHERE key = 'listing_complete'").fetchone()
+        return row is not None
+
+    def mark_listing_complete(self):
+        self._connection.execute("INSERT OR REPLACE INTO crawl_state VALUES ('listing_complete', '1')")
+        self._connection.commit()
+
+    def add_titles(self, urls):
+        """
+        :return: the number of urls that were not already known
+        """
+        before = self._connection.total_changes
+        self._connection.executemany('INSERT OR IGNORE INTO titles (url) VALUES (?)', [(url,) for url in urls])
+        self._connection.commit()
+        return self._connection.total_changes - before
+
+    def pending_titles(self, refresh=False):
+        """
+        :param refresh: if True, include already fetched titles, so their transcripts are revalidated
+        :return: a list of (url, download_url, etag, last_modified) for titles to fetch
+        """
+        query = 'SELECT url, download_url, etag, last_modified FROM titles'
+        if not refresh:
+            query += ' WHERE fetched_at IS NULL'
+        return self._connection.execute(query + ' ORDER BY rowid').fetchall()
 
+    def store(self, url, download_url, etag, last_modified, text):
+        self._connection.execute('UPDATE titles SET download_url = ?, etag = ?, last_modified = ?, text = ?, '
+                                 'fetched_at = ? WHERE url = ?',
+                                 (download_url, etag, last_modified, text, time.time(), url))
+        self._connection.commit()
 
-def get_all_title_pages():
-    resp = requests.get(BASE_PAGE % ('', ), headers=HEADERS)
+    def texts(self):
+        for text, in self._connection.execute('SELECT text FROM titles WHERE text IS NOT NULL ORDER BY rowid'):
+            yield text
+
+    def close(self):
+        self._connection.close()
+
+
+def _parse_title_pages(resp, host):
     soup = BeautifulSoup(resp.content, 'lxml')
-    title_pages = [div.find('a')['href'] for div in soup.find_all('div', {'class': 'title'})]
-    all_title_pages = title_pages
+    return [urljoin(host, div.find('a')['href']) for div in soup.find_all('div', {'class': 'title'})]
+
+
+def update_title_pages(fetcher, cache, host=HOST):
+    """
+    paginates the listing, adding title pages to the cache as they are seen. once a previous crawl has seen the whole
+    listing, pagination stops at the first page with an already known title, since the listing is newest first
+
+    :return: the number of new title pages
+    """
+    listing_complete = cache.is_listing_complete()
+    new_title_pages = 0
     page = 1
 
-    while len(title_pages) > 0:
-        page += 1
-        resp = requests.get(BASE_PAGE % ('page' + str(page), ), headers=HEADERS)
-        soup = BeautifulSoup(resp.content, 'lxml')
-        title_pages = [div.find('a')['href'] for div in soup.find_all('div', {'class': 'title'})]
-        all_title_pages += title_pages
+    while True:
+        resp = fetcher.get(urljoin(host, LISTING_PATH % ('page' + str(page) if page > 1 else '', )))
+        # a failed page (e.g. still rate limited once retries run out) has no titles either, but isn't the end of the
+        # listing. the crawl stops short of it, and since the listing isn't marked complete the next run paginates again
+        if not resp.ok:
+            print(f'Stopping the listing at page {page}, which failed with status {resp.status_code}')
+            break
 
-    return all_title_pages
+        title_pages = _parse_title_pages(resp, host)
+        if len(title_pages) == 0:
+            cache.mark_listing_complete()
+            break
 
+        page_new_title_pages = cache.add_titles(title_pages)
+        new_title_pages += page_new_title_pages
+        if listing_complete and page_new_title_pages < len(title_pages):
+            break
+        page += 1
 
-def get_text_for_title(url):
-    resp = requests.get(url, headers=HEADERS)
-    soup = BeautifulSoup(resp.content, 'lxml')
-    download_a = soup.find('a', {'id': 'downloadtext'})
+    return new_title_pages
 
-    if not download_a:
-        return None
 
-    download_link = HOST + download_a['href']
-    dl_resp = requests.get(download_link, headers=HEADERS)
+def _fetch_transcript(url, download_url, etag, last_modified, fetcher, host):
+    """
+    fetches the transcript for a title page. if it was fetched before, the download is revalidated with its ETag and
+    Last-Modified
 
-    return dl_resp.text
+    :return: a tuple of download url, ETag, Last-Modified and transcript text (None if the title has no transcript),
+    or None if there's nothing new to store
+    """
+    if download_url:
+        conditional_headers = {}
+        if etag:
+            conditional_headers['If-None-Match'] = etag
+        if last_modified:
+            conditional_headers['If-Modified-Since'] = last_modified
+        dl_resp = fetcher.get(download_url, headers=conditional_headers)
+    else:
+        resp = fetcher.get(url)
+        if not resp.ok:
+            return None
+        soup = BeautifulSoup(resp.content, 'lxml')
+        download_a = soup.find('a', {'id': 'downloadtext'})
 
+        if not download_a:
+            return None, None, None, None
 
-def get_all_texts():
-    title_page_urls = get_all_title_pages()
-    all_texts = []
+        download_url = urljoin(host, download_a['href'])
+        dl_resp = fetcher.get(download_url)
 
-    for url in title_page_urls:
-        text = get_text_for_title(url)
-        if text:
-            all_texts.append(text)
-        time.sleep(1)
+    # unchanged, failed, or rate limited downloads are left as they were, so they are retried on the next run
+    if dl_resp.status_code == 304 or not dl_resp.ok or DOWNLOAD_LIMIT_BANNER in dl_resp.text:
+        return None
 
-    return all_texts
+    return download_url, dl_resp.headers.get('ETag'), dl_resp.headers.get('Last-Modified'), dl_resp.text
 
 
-if __name__ == "__main__":
-    all_transcripts = get_all_texts()
+def get_all_texts(host=HOST, cache_path='./transcripts.sqlite', concurrency=8, requests_per_second=2, refresh=False):
+    """
+    :param host: the site to scrape, e.g. a local stand-in server for testing
+    :param cache_path: the sqlite file transcripts are stored in as they are fetched
+    :param concurrency: the number of title pages fetched at once
+    :param requests_per_second: the average request rate across all fetches
+    :param refresh: if True, revalidate previously fetched transcripts as well as fetching new ones
+    :return: the transcript of every known title with one
+    """
+    fetcher = Fetcher(concurrency=concurrency, requests_per_second=requests_per_second)
+    cache = TranscriptCache(cache_path)
+    try:
+        update_title_pages(fetcher, cache, host)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            future_to_url = {executor.submit(_fetch_transcript, *pending, fetcher, host): pending[0]
+                             for pending in cache.pending_titles(refresh)}
+            for future in as_completed(future_to_url):
+                fetched = future.result()
+                if fetched is not None:
+                    cache.store(future_to_url[future], *fetched)
 
-    with open('./transcripts.txt', 'w') as f:
-        f.writelines(all_transcripts)
+        return list(cache.texts())
+    finally:
+        cache.close()
+        fetcher.close()
 
-    # with open('./all_transcripts.txt', 'r') as f:
-    #    all_transcripts = f.readlines()
 
-    corpus = '\n'.join(all_transcripts)
-    corpus = corpus.replace("You can't download more then 50 subtitles per day!", "")
-    corpus = corpus.replace("(AUDIENCE LAUGHS)", "")
-    corpus = corpus.replace("(AUDIENCE LAUGHING)", "")
-    words = nltk.word_tokenize(corpus)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Scrapes Last Week Tonight transcripts and reports common phrases')
+    parser.add_argument('--epsilon', type=float,
+                        help='count phrases approximately in fixed memory, overestimating by at most this fraction of '
+                             'the phrases seen. counts are exact if omitted')
+    parser.add_argument('--processes', type=int,
+                        help='the number of processes transcripts are tokenized and counted across. defaults to the '
+                             'number of cores for scraped transcripts, and to 1 for --transcripts-file, which is only '
+                             'streamed in bounded memory when counted serially')
+    parser.add_argument('--transcripts-file',
+                        help='count phrases in a previously saved transcripts file (e.g. ./transcripts.txt) rather '
+                             'than scraping. counts match those of the scraped transcripts, except for files saved '
+                             'without transcript separators (e.g. ./all_transcripts.txt), which count as one '
+                             'transcript')
+    parser.add_argument('--index',
+                        help='a directory to persist the counts to, for querying later with ngrams.NgramIndex')
+    args = parser.parse_args()
 
-    bigrams = Counter(list(nltk.ngrams(words, 2)))
-    trigrams = Counter(list(nltk.ngrams(words, 3)))
-    quadgrams = Counter(list(nltk.ngrams(words, 4)))
-    quintgrams = Counter(list(nltk.ngrams(words, 5)))
-    sextgrams = Counter(list(nltk.ngrams(words, 6)))
+    if args.transcripts_file:
+        ngram_counter = count_file(args.transcripts_file, orders=range(2, 7), epsilon=args.epsilon,
+                                   processes=args.processes or 1)
+    else:
+        all_transcripts = get_all_texts()
 
-    sorted_tri = sorted(trigrams.items(), key=lambda kv: kv[1], reverse=True)
-    sorted_quad = sorted(quadgrams.items(), key=lambda kv: kv[1], reverse=True)
-    sorted_quint = sorted(quintgrams.items(), key=lambda kv: kv[1], reverse=True)
-    sorted_sext = sorted(quintgrams.items(), key=lambda kv: kv[1], reverse=True)
+        write_transcripts(all_transcripts, './transcripts.txt')
 
-    print('\n'.join([str(x[1]) + ": " + ' '.join(x[0]) for x in sorted_quint[1:100]]))
-    print('\n'.join([str(x[1]) + ": " + ' '.join(x[0]) for x in sorted_sext[1:100]]))
-    print('\n'.join([str(x[1]) + ": " + ' '.join(x[0]) for x in sorted_quad[1:100]]))
-    print('\n'.join([str(x[1]) + ": " + ' '.join(x[0]) for x in sorted_tri[1:100]]))
+        ngram_counter = count_transcripts(all_transcripts, orders=range(2, 7), epsilon=args.epsilon,
+                                          processes=args.processes or os.cpu_count())
 
+    if args.index:
+        ngram_counter.write_index(args.index)
 
+    for order in [5, 6, 4, 3]:
+        print('\n'.join([str(count) + ": " + ' '.join(ngram) for ngram, count in ngram_counter.most_common(order, 100)]))
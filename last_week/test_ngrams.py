@@ -0,0 +1,112 @@
+import random
+
+import pytest
+
+from ngrams import NgramCounter, NgramIndex, count_file, count_transcripts, write_transcripts
+
+ORDERS = [2, 3]
+EPSILON = 1e-2
+# a most_common k larger than the number of distinct n-grams, to list them all
+EVERY_NGRAM = 10 ** 6
+
+
+def _zipf_tokens(number_of_tokens, vocabulary_size=200, seed=0):
+    rng = random.Random(seed)
+    vocabulary = ['token%d' % rank for rank in range(vocabulary_size)]
+    weights = [1 / (rank + 1) for rank in range(vocabulary_size)]
+    return rng.choices(vocabulary, weights, k=number_of_tokens)
+
+
+def _assert_within_bounds(exact_counter, approximate_counter):
+    """
+    checks every n-gram seen, whether or not the approximate counter still tracks it
+    """
+    for order in ORDERS:
+        error_bound = approximate_counter.error_bound(order)
+        tracked_ngrams = {ngram for ngram, _ in approximate_counter.most_common(order, EVERY_NGRAM)}
+        exact_counts = exact_counter.most_common(order, EVERY_NGRAM)
+        for ngram, exact_count in exact_counts:
+            approximate_count = approximate_counter.count(ngram)
+            assert exact_count <= approximate_count <= exact_count + error_bound, (ngram, exact_count,
+                                                                                  approximate_count)
+
+        # the stream is long enough that most n-grams fall out of the summary, so untracked n-grams are exercised
+        assert any(ngram not in tracked_ngrams for ngram, _ in exact_counts)
+
+
+def test_approximate_counts_bound_exact_counts():
+    tokens = _zipf_tokens(50000)
+    exact_counter = NgramCounter(ORDERS)
+    exact_counter.update(tokens)
+    approximate_counter = NgramCounter(ORDERS, EPSILON)
+    approximate_counter.update(tokens)
+
+    _assert_within_bounds(exact_counter, approximate_counter)
+
+
+def test_merged_approximate_counts_bound_exact_counts():
+    tokens = _zipf_tokens(50000)
+    exact_counter = NgramCounter(ORDERS)
+    approximate_counter = NgramCounter(ORDERS, EPSILON)
+    for start in range(0, len(tokens), 10000):
+        exact_counter.update(tokens[start:start + 10000])
+        partial_counter = NgramCounter(ORDERS, EPSILON)
+        partial_counter.update(tokens[start:start + 10000])
+        approximate_counter.merge(partial_counter)
+
+    _assert_within_bounds(exact_counter, approximate_counter)
+
+
+def test_file_counts_match_transcript_counts(tmp_path):
+    transcripts = ['(AUDIENCE LAUGHS) and now\nthis is the end\n\nof the show',
+                   'this is the end of\nthe show and now',
+                   '',
+                   "You can't download more then 50 subtitles per day! and now this\n"]
+    path = str(tmp_path / 'transcripts.txt')
+    write_transcripts(transcripts, path)
+
+    transcript_counter = count_transcripts(transcripts, ORDERS, tokenize=str.split)
+    for processes in [1, 2]:
+        file_counter = count_file(path, ORDERS, tokenize=str.split, processes=processes)
+        for order in ORDERS:
+            assert file_counter.most_common(order, EVERY_NGRAM) == transcript_counter.most_common(order, EVERY_NGRAM)
+
+
+def test_index_counts_match_counter(tmp_path):
+    tokens = _zipf_tokens(50000)
+    exact_counter = NgramCounter(ORDERS)
+    exact_counter.update(tokens)
+    for epsilon in [None, EPSILON]:
+        ngram_counter = NgramCounter(ORDERS, epsilon)
+        ngram_counter.update(tokens)
+        directory = str(tmp_path / str(epsilon))
+        ngram_counter.write_index(directory)
+
+        ngram_index = NgramIndex(directory)
+        for order in ORDERS:
+            for ngram, _ in exact_counter.most_common(order, EVERY_NGRAM):
+                assert ngram_index.count(ngram) == ngram_counter.count(ngram)
+
+
+def test_file_without_separators_counts_as_one_transcript(tmp_path):
+    transcript = 'this is the end\nof the show and now\nthis is the end of the show\n'
+    path = tmp_path / 'all_transcripts.txt'
+    path.write_text(transcript)
+
+    transcript_counter = count_transcripts([transcript], ORDERS, tokenize=str.split)
+    file_counter = count_file(str(path), ORDERS, tokenize=str.split)
+    for order in ORDERS:
+        assert file_counter.most_common(order, EVERY_NGRAM) == transcript_counter.most_common(order, EVERY_NGRAM)
+
+
+def test_index_rejects_unindexed_orders(tmp_path):
+    ngram_counter = NgramCounter(ORDERS)
+    ngram_counter.update(_zipf_tokens(1000))
+    directory = str(tmp_path / 'index')
+    ngram_counter.write_index(directory)
+
+    ngram_index = NgramIndex(directory)
+    with pytest.raises(ValueError, match=r'only orders \[2, 3\]'):
+        ngram_index.count(('token0', 'token1', 'token2', 'token3'))
+    with pytest.raises(ValueError, match='Order 4'):
+        ngram_index.continuations(('token0', 'token1', 'unseen'))
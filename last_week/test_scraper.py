@@ -0,0 +1,47 @@
+import requests
+
+from scraper import LISTING_PATH, TranscriptCache, update_title_pages
+
+HOST = 'http://lastweek.test'
+
+
+def _response(status_code, titles=()):
+    resp = requests.Response()
+    resp.status_code = status_code
+    resp._content = ''.join('<div class="title"><a href="/%s">%s</a></div>' % (title, title)
+                            for title in titles).encode('utf-8')
+    return resp
+
+
+class _ListingFetcher:
+    """
+    serves listing pages from a dict of path to response, any other page being past the end of the listing
+    """
+    def __init__(self, path_to_response):
+        self.path_to_response = path_to_response
+
+    def get(self, url, headers=None):
+        return self.path_to_response.get(url[len(HOST):], _response(200))
+
+
+def test_failed_listing_page_is_not_the_end_of_the_listing(tmp_path):
+    pages = {LISTING_PATH % '': _response(200, ['title-5', 'title-4']),
+             LISTING_PATH % 'page2': _response(503),
+             LISTING_PATH % 'page3': _response(200, ['title-1'])}
+    cache = TranscriptCache(str(tmp_path / 'transcripts.sqlite'))
+    try:
+        assert update_title_pages(_ListingFetcher(pages), cache, HOST) == 2
+        assert not cache.is_listing_complete()
+
+        pages[LISTING_PATH % 'page2'] = _response(200, ['title-3', 'title-2'])
+        assert update_title_pages(_ListingFetcher(pages), cache, HOST) == 3
+        assert cache.is_listing_complete()
+
+        # once the whole listing has been seen, only the leading pages are paginated
+        pages[LISTING_PATH % ''] = _response(200, ['title-6', 'title-5'])
+        pages[LISTING_PATH % 'page2'] = _response(503)
+        assert update_title_pages(_ListingFetcher(pages), cache, HOST) == 1
+        assert [url for url, _, _, _ in cache.pending_titles()] == \
+            [HOST + '/title-%d' % title for title in [5, 4, 3, 2, 1, 6]]
+    finally:
+        cache.close()
@@ -1,50 +1,115 @@
+import hashlib
+import json
+import os
 import re
-from datetime import timedelta, datetime
+from io import StringIO
 
 import pandas as pd
 import requests
-from bs4 import BeautifulSoup
-
-def parse_time_millis(time_unparsed,
-                      time_format='%S.%f',
-                      time_format_fallback='%M:%S.%f',
-                      time_format_fallback2 = '%H:%M:%S.%f',
-		      time_format_fallback3 = '%H:%M:%S'):
-    dt = None
+
+WORLD_RECORDS_URL = 'https://en.wikipedia.org/wiki/List_of_world_records_in_athletics'
+RECORD_TABLE_ATTRS = {'class': 'wikitable sortable plainrowheaders'}
+# pages to ingest, as (url, the attributes of its tables of interest, the columns labelling each of those tables in
+# page order). e.g. national or age group record pages would add their own labels
+SOURCES = [
+    (WORLD_RECORDS_URL, RECORD_TABLE_ATTRS, [{'gender': 'male'}, {'gender': 'female'}]),
+]
+PERFORMANCE_COLUMN = 'Perf.'
+
+# ss.f, mm:ss.f, hh:mm:ss.f or hh:mm:ss, as parsed by strptime's %H, %M, %S and %f
+TIME_PATTERN = re.compile(r'^(?:(?:(?P<hours>\d{1,2}):)?(?P<minutes>\d{1,2}):)?(?P<seconds>\d{1,2})'
+                          r'(?:\.(?P<fraction>\d{1,6}))?\Z')
+
+
+def parse_time_millis(times):
+    """
+    :param times: a Series of performance strings
+    :return: a Series of their durations in milliseconds, NaN where a performance isn't a time
+    """
+    parts = times.astype(str).str.extract(TIME_PATTERN)
+    hours = pd.to_numeric(parts['hours'])
+    minutes = pd.to_numeric(parts['minutes'])
+    seconds = pd.to_numeric(parts['seconds'])
+    # the fraction is right padded so that e.g. .5 is 500000 microseconds, as %f reads it
+    fraction_millis = pd.to_numeric(parts['fraction'].str.ljust(6, '0')) / 1000
+
+    # a fraction is only optional with hours, and each field must be in strptime's range
+    valid = (seconds.notna() & (fraction_millis.notna() | hours.notna()) & ~(hours > 23) & ~(minutes > 59) &
+             ~(seconds > 59))
+    millis = ((hours.fillna(0) * 60 + minutes.fillna(0)) * 60 + seconds) * 1000 + fraction_millis.fillna(0)
+
+    return millis.where(valid)
+
+
+def fetch_cached(url, cache_dir='./html_cache'):
+    """
+    fetches a page, keeping its html on disk alongside its ETag and Last-Modified. a cached page is revalidated with
+    them, so it's only downloaded again if it changed
+
+    :return: the page's html
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = os.path.join(cache_dir, hashlib.sha1(url.encode('utf-8')).hexdigest())
+    html_path, validators_path = cache_path + '.html', cache_path + '.json'
+
+    conditional_headers = {}
+    if os.path.exists(html_path) and os.path.exists(validators_path):
+        with open(validators_path, 'r') as f:
+            validators = json.load(f)
+        if validators.get('etag'):
+            conditional_headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            conditional_headers['If-Modified-Since'] = validators['last_modified']
+
+    resp = requests.get(url, headers=conditional_headers)
+    if resp.status_code == 304:
+        with open(html_path, 'r', encoding='utf-8') as f:
+            return f.read()
+    resp.raise_for_status()
+
+    # the html is written before its validators, so the validators never describe a page that wasn't saved
+    with open(html_path, 'w', encoding='utf-8') as f:
+        f.write(resp.text)
+    with open(validators_path, 'w') as f:
+        json.dump({'url': url, 'etag': resp.headers.get('ETag'), 'last_modified': resp.headers.get('Last-Modified')},
+                  f)
+
+    return resp.text
+
+
+def read_records(html, table_attrs, table_labels):
+    """
+    parses the page's tables matching table_attrs in a single lxml pass, keeping the rows with a timed performance
+
+    :param table_labels: a dict of constant columns for each table, in page order
+    :return: a DataFrame of the labelled tables' rows, with their duration in milliseconds
+    """
+    tables = pd.read_html(StringIO(html), flavor='lxml', attrs=table_attrs)
+    labelled_tables = []
+    for table, labels in zip(tables, table_labels):
+        table['duration'] = parse_time_millis(table[PERFORMANCE_COLUMN])
+        labelled_tables.append(table[~pd.isnull(table['duration'])].assign(**labels))
+
+    return pd.concat(labelled_tables)
+
+
+def ingest(sources=SOURCES, cache_dir='./html_cache', output_path='./records'):
+    """
+    writes the records of every source to output_path.csv, and with typed columns to output_path.parquet if a parquet
+    engine (pyarrow or fastparquet) is installed
+    """
+    records = pd.concat([read_records(fetch_cached(url, cache_dir), table_attrs, table_labels)
+                         for url, table_attrs, table_labels in sources])
+
+    records.to_csv(output_path + '.csv')
     try:
-        dt = datetime.strptime(time_unparsed, time_format)
-    except:
-        try:
-            dt = datetime.strptime(time_unparsed, time_format_fallback)
-        except:
-            try:
-                dt = datetime.strptime(time_unparsed, time_format_fallback2)
-            except:
-		try:
-                    dt = datetime.strptime(time_unparsed, time_format_fallback3)
-		except:
-                    return None
-    delta = timedelta(hours=dt.hour, minutes=dt.minute, seconds=dt.second)
-    return delta.total_seconds() * 1000
-
-
-resp = requests.get('https://en.wikipedia.org/wiki/List_of_world_records_in_athletics')
-soup = BeautifulSoup(resp.text, 'lxml')
-
-record_tables = soup.find_all('table', {'class': 'wikitable sortable plainrowheaders'})
-
-men_table_raw = record_tables[0]
-women_table_raw = record_tables[1]
-
-men_table = pd.read_html(str(men_table_raw))[0]
-women_table = pd.read_html(str(women_table_raw))[0]
-
-men_table['duration'] = [parse_time_millis(t) for t in men_table['Perf.']]
-women_table['duration'] = [parse_time_millis(t) for t in women_table['Perf.']]
-
-me = men_table[~pd.isnull(men_table['duration'])]
-we = women_table[~pd.isnull(women_table['duration'])]
-me['gender'] = 'male'
-we['gender'] = 'female'
-
-pd.concat([me, we]).to_csv('./records.csv')
+        records.convert_dtypes(convert_integer=False).to_parquet(output_path + '.parquet', index=False)
+    except ImportError as e:
+        # a parquet from an earlier run would no longer match the csv
+        if os.path.exists(output_path + '.parquet'):
+            os.remove(output_path + '.parquet')
+        print(f'Skipping {output_path}.parquet, since no parquet engine is installed: {e}')
+
+
+if __name__ == '__main__':
+    ingest()
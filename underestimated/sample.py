@@ -1,29 +1,322 @@
-import nbib
-from random import sample
+import argparse
+import math
+import os
+import random
+import re
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice, repeat
+from urllib.parse import urlencode
+from urllib.request import urlopen
 
+# the NBIB tags kept from each record, named as nbib.read_file names them
+TAG_TO_FIELD = {'PMID': 'pubmed_id', 'TI': 'title', 'AB': 'abstract'}
+PHRASES = ['overestimated', 'underestimated', 'overstated', 'understated']
+# every variant of the phrase of interest, case insensitively, in a single pass
+INTERESTING_PHRASE = re.compile(r'cannot be (%s)' % '|'.join(PHRASES), re.IGNORECASE)
+RECORD_START = b'PMID-'
+EUTILS_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/'
+# PubMed's search rejects very long queries, so queries are kept well under its limits
+MAX_QUERY_PMIDS = 200
+MAX_QUERY_LENGTH = 4000
 
-# the details of a sampling strategy can be ironed out later
-# e.g. we may wish to do stratified sampling on keyword underestimate/overestimate/understate/overstate
-# for now we just perform a simple random sample
-def pmid_sample(data, n=1500):
-    pmids = [ue['pubmed_id'] for ue in data]
-    return sample(pmids, min(n, len(data)))
+
+class Reservoir:
+    """
+    a uniform random sample of up to n of the items offered, in a single pass (Li's Algorithm L). once full, rather
+    than drawing a random number per item, it draws how many items to skip before the next replacement
+    """
+    def __init__(self, n, rng=random):
+        self.items = []
+        self._n = n
+        self._rng = rng
+        self._w = 1.0
+        self._skip = 0
+
+    def _uniform(self):
+        """
+        :return: a uniform random number in (0, 1), which unlike [0, 1) is safe to take the log of
+        """
+        u = self._rng.random()
+        while u == 0:
+            u = self._rng.random()
+        return u
+
+    def _draw_next(self):
+        self._w *= math.exp(math.log(self._uniform()) / self._n)
+        self._skip = math.floor(math.log(self._uniform()) / math.log(1 - self._w))
+
+    def offer(self, item):
+        if len(self.items) < self._n:
+            self.items.append(item)
+            if len(self.items) == self._n:
+                self._draw_next()
+        elif self._n > 0:
+            if self._skip > 0:
+                self._skip -= 1
+            else:
+                self.items[self._rng.randrange(self._n)] = item
+                self._draw_next()
+
+
+def pmid_sample(records, n=1500, rng=random):
+    """
+    :param records: an iterable of records, e.g. a stream from filter_file
+    :return: a simple random sample of n of the records' pmids (all of them, if there are fewer)
+    """
+    reservoir = Reservoir(n, rng)
+    for record in records:
+        reservoir.offer(record['pubmed_id'])
+    return reservoir.items
+
+
+def record_phrase(record):
+    """
+    :return: the phrase (one of PHRASES) of the first interesting phrase in the record's abstract, else its title, or
+    None if it has none
+    """
+    for field in ('abstract', 'title'):
+        match = INTERESTING_PHRASE.search(record.get(field, ''))
+        if match:
+            return match.group(1).lower()
+    return None
+
+
+def stratified_pmid_sample(records, n=1500 // len(PHRASES), rng=random):
+    """
+    samples the records of each phrase separately, so rarer phrases are as well represented as common ones. a record is
+    stratified by the first phrase it contains (see record_phrase)
+
+    :param n: the sample size for each phrase
+    :return: a dict from each phrase to a simple random sample of n of its records' pmids
+    """
+    phrase_to_reservoir = {phrase: Reservoir(n, rng) for phrase in PHRASES}
+    for record in records:
+        phrase = record_phrase(record)
+        if phrase is not None:
+            phrase_to_reservoir[phrase].offer(record['pubmed_id'])
+    return {phrase: reservoir.items for phrase, reservoir in phrase_to_reservoir.items()}
 
 
 def pubmed_format_query(pmids):
     return ' or '.join('%s[pmid]' % p for p in pmids)
 
 
+def batch_queries(pmids, max_pmids=MAX_QUERY_PMIDS, max_length=MAX_QUERY_LENGTH):
+    """
+    :return: a generator of queries for consecutive batches of the pmids, each of at most max_pmids pmids and
+    max_length characters, so one failed query doesn't lose the whole set
+    """
+    batch, length = [], 0
+    for pmid in pmids:
+        term_length = len('%s[pmid]' % pmid) + (len(' or ') if batch else 0)
+        if batch and (len(batch) == max_pmids or length + term_length > max_length):
+            yield pubmed_format_query(batch)
+            batch, length = [], 0
+            term_length -= len(' or ')
+        batch.append(pmid)
+        length += term_length
+    if batch:
+        yield pubmed_format_query(batch)
+
+
+def write_queries(pmids, path, max_pmids=MAX_QUERY_PMIDS, max_length=MAX_QUERY_LENGTH):
+    """
+    writes batched queries for the pmids to the file, one per line
+
+    :return: the number of queries written
+    """
+    query_count = 0
+    with open(path, 'w') as f:
+        for query in batch_queries(pmids, max_pmids, max_length):
+            f.write(query + '\n')
+            query_count += 1
+    return query_count
+
+
+def read_retrieved(path):
+    """
+    :return: the set of pmids in a cache file of already retrieved pmids, one per line, empty if it doesn't exist
+    """
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'r') as f:
+        return {int(line) for line in f if line.strip()}
+
+
+def exclude_retrieved(pmids, retrieved):
+    """
+    :return: a generator of the pmids not already retrieved, dropping duplicates
+    """
+    seen = set(retrieved)
+    for pmid in pmids:
+        if pmid not in seen:
+            seen.add(pmid)
+            yield pmid
+
+
+def efetch(pmids, output_path, retrieved_path, base_url=EUTILS_URL, batch_size=MAX_QUERY_PMIDS):
+    """
+    appends the MEDLINE (NBIB) records of the pmids to the output file in batches via E-utilities efetch, recording
+    each batch's pmids in the retrieved cache once it is written, so an interrupted pull resumes where it stopped
+
+    :param base_url: the E-utilities root, e.g. a local stub server for testing
+    :return: the number of pmids fetched
+    """
+    pmids = iter(pmids)
+    fetched_count = 0
+    while True:
+        batch = list(islice(pmids, batch_size))
+        if not batch:
+            return fetched_count
+
+        # ids are POSTed, since a GET with hundreds of them runs into URL length limits
+        data = urlencode({'db': 'pubmed', 'id': ','.join(map(str, batch)), 'rettype': 'medline',
+                          'retmode': 'text'}).encode('ascii')
+        with urlopen(base_url.rstrip('/') + '/efetch.fcgi', data=data) as resp:
+            records = resp.read().decode('utf-8')
+
+        with open(output_path, 'a', encoding='utf-8') as f:
+            f.write(records.rstrip('\n') + '\n\n')
+        with open(retrieved_path, 'a') as f:
+            f.writelines('%s\n' % pmid for pmid in batch)
+        fetched_count += len(batch)
+
+
 def contains_interesting_phrase(abstract):
-    abstract_lower = abstract.lower()
-    return 'cannot be overestimated' in abstract_lower or 'cannot be underestimated' in abstract_lower or\
-           'cannot be overstated' in abstract_lower or 'cannot be understated' in abstract_lower
-
-
-all_records = nbib.read_file('./data/pubmed-cannotandu-set.nbib')
-# since our pubmed strategy:
-# cannot and (underestimated or overestimated or understated or overstated)
-# is unable to do exact phrase searching with the stop word cannot, we cast a wide net and then filter it down
-# programmatically with case insensitive matching
-filtered_records = [r for r in all_records if ('abstract' in r and contains_interesting_phrase(r['abstract'])) or ('title' in r and contains_interesting_phrase(r['title']))]
-print(pubmed_format_query(pmid_sample(filtered_records)))
\ No newline at end of file
+    return INTERESTING_PHRASE.search(abstract) is not None
+
+
+def _parse_field(tag, lines):
+    return int(lines[0]) if tag == 'PMID' else ' '.join(line.strip() for line in lines)
+
+
+def read_records(lines):
+    """
+    parses records one at a time from an NBIB (MEDLINE format) export, keeping only the tags in TAG_TO_FIELD. a tag's
+    value continues onto following lines indented with spaces, and a blank line ends a record
+
+    :param lines: lines of the export, e.g. an open file, consumed lazily
+    :return: a generator of record dicts
+    """
+    record = {}
+    tag, tag_lines = None, []
+    for line in chain(lines, ['']):
+        line = line.rstrip('\r\n')
+        if line[:4].strip() and line[4:6] in ('- ', '-'):
+            if tag in TAG_TO_FIELD:
+                record[TAG_TO_FIELD[tag]] = _parse_field(tag, tag_lines)
+            tag, tag_lines = line[:4].rstrip(), [line[6:]]
+        elif line:
+            tag_lines.append(line)
+        else:
+            if tag in TAG_TO_FIELD:
+                record[TAG_TO_FIELD[tag]] = _parse_field(tag, tag_lines)
+            if record:
+                yield record
+            record = {}
+            tag, tag_lines = None, []
+
+
+def filter_records(records):
+    """
+    since our pubmed strategy:
+    cannot and (underestimated or overestimated or understated or overstated)
+    is unable to do exact phrase searching with the stop word cannot, we cast a wide net and then filter it down
+    programmatically with case insensitive matching
+
+    :return: a generator of the records with the phrase in their abstract or title
+    """
+    for r in records:
+        if ('abstract' in r and contains_interesting_phrase(r['abstract'])) or\
+                ('title' in r and contains_interesting_phrase(r['title'])):
+            yield r
+
+
+def _read_range(path, start, end):
+    """
+    :return: a generator of the lines of records whose PMID line begins in [start, end) bytes of the file. the last
+    record is read to its end, even past end
+    """
+    with open(path, 'rb') as f:
+        if start > 0:
+            # skip to the first line beginning at or after start
+            f.seek(start - 1)
+            f.readline()
+
+        in_range = False
+        while True:
+            position = f.tell()
+            line = f.readline()
+            if not line:
+                break
+            if line.startswith(RECORD_START):
+                if position >= end:
+                    break
+                in_range = True
+            if in_range:
+                yield line.decode('utf-8')
+
+
+def _filter_range(path, start, end):
+    return list(filter_records(read_records(_read_range(path, start, end))))
+
+
+def filter_file(path, processes=1, ranges_per_process=4):
+    """
+    streams records of an NBIB export, keeping those with the phrase. with several processes, the file is split into
+    byte ranges that are parsed and filtered independently, each starting at a record boundary
+
+    :return: a generator of the matching records, in file order
+    """
+    if processes == 1:
+        with open(path, 'r', encoding='utf-8') as f:
+            yield from filter_records(read_records(f))
+        return
+
+    size = os.path.getsize(path)
+    range_count = processes * ranges_per_process
+    starts = [size * index // range_count for index in range(range_count)]
+    ends = starts[1:] + [size]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for range_records in executor.map(_filter_range, repeat(path), starts, ends):
+            yield from range_records
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Samples PubMed records saying something cannot be over or '
+                                                 'underestimated, printing a PubMed query for them')
+    parser.add_argument('--nbib', default='./data/pubmed-cannotandu-set.nbib', help='the PubMed NBIB export to sample')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help='the number of processes the export is parsed and filtered across')
+    parser.add_argument('--sample-size', type=int, default=1500, help='the number of pmids to sample')
+    parser.add_argument('--stratified', action='store_true',
+                        help='sample an equal share of the pmids for each of ' + ', '.join(PHRASES))
+    parser.add_argument('--seed', type=int, help='seeds the sample, for reproducibility')
+    parser.add_argument('--queries', help='write batched queries to this file, one per line, rather than printing a '
+                                          'single query')
+    parser.add_argument('--retrieved', help='a file of already retrieved pmids, one per line, to leave out of the '
+                                            'queries and fetch')
+    parser.add_argument('--efetch', help='append the MEDLINE records of the sampled pmids to this file, recording '
+                                         'them in --retrieved')
+    parser.add_argument('--eutils-url', default=EUTILS_URL, help='the E-utilities root to fetch from')
+    args = parser.parse_args()
+    if args.efetch and not args.retrieved:
+        parser.error('--efetch requires --retrieved')
+
+    rng = random.Random(args.seed)
+    filtered_records = filter_file(args.nbib, args.processes)
+    if args.stratified:
+        phrase_to_pmids = stratified_pmid_sample(filtered_records, args.sample_size // len(PHRASES), rng)
+        pmids = list(chain.from_iterable(phrase_to_pmids.values()))
+    else:
+        pmids = pmid_sample(filtered_records, args.sample_size, rng)
+    if args.retrieved:
+        pmids = list(exclude_retrieved(pmids, read_retrieved(args.retrieved)))
+
+    if args.queries:
+        write_queries(pmids, args.queries)
+    else:
+        print(pubmed_format_query(pmids))
+
+    if args.efetch:
+        efetch(pmids, args.efetch, args.retrieved, args.eutils_url)
@@ -0,0 +1,26 @@
+import os
+
+import nbib
+
+from sample import filter_file, read_records
+
+SAMPLE_NBIB = os.path.join(os.path.dirname(__file__), 'test_data', 'sample.nbib')
+FIELDS = ['pubmed_id', 'title', 'abstract']
+
+
+def _fields(records):
+    return [{field: record[field] for field in FIELDS if field in record} for record in records]
+
+
+def test_read_records_matches_nbib():
+    with open(SAMPLE_NBIB, 'r', encoding='utf-8') as f:
+        records = list(read_records(f))
+
+    assert _fields(records) == _fields(nbib.read_file(SAMPLE_NBIB))
+
+
+def test_filter_file_is_the_same_across_processes():
+    pmids = [record['pubmed_id'] for record in filter_file(SAMPLE_NBIB)]
+
+    assert pmids == [31000001, 31000002, 31000004]
+    assert [record['pubmed_id'] for record in filter_file(SAMPLE_NBIB, processes=2, ranges_per_process=3)] == pmids
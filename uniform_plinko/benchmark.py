@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from uniform_plinko import Board
+
+DEFAULT_DEPTHS = list(range(3, 21)) + [50, 100, 200]
+# stages that enumerate every path or build a full DOM are only run on boards up to these depths
+MAX_PATH_DEPTH = 14
+MAX_RENDER_DEPTH = 50
+MAX_SOLVE_DEPTH = 50
+
+
+def _skewed_targets(board):
+    # a linear ramp, so solve exercises the optimizer rather than the closed form uniform solution
+    bucket_indices = board.get_bucket_indices()
+    weights = np.linspace(1, 2, len(bucket_indices))
+    return dict(zip(bucket_indices, (weights / weights.sum()).tolist()))
+
+
+def _stages(depth, output_directory):
+    """
+    :return: a list of (stage name, zero argument callable) to benchmark for a depth
+    """
+    board = Board(depth)
+    system = board.resolve_to_system()
+    bucket_indices = board.get_bucket_indices()
+    uniform_targets = {ix: 1 / len(bucket_indices) for ix in bucket_indices}
+    skewed_targets = _skewed_targets(board)
+
+    left_probabilities = system.solve(uniform_targets)
+    batch_probabilities = np.random.default_rng(0).random((1000, board.get_number_of_pegs()))
+    rendered_board = Board(depth)
+    rendered_board.set_probabilities(left_probabilities, system.evaluate(left_probabilities))
+    svg_path = os.path.join(output_directory, 'plinko.svg')
+
+    stages = [
+        ('board', lambda: Board(depth)),
+        ('resolve_to_system', board.resolve_to_system),
+        ('evaluate', lambda: system.evaluate(left_probabilities)),
+        ('evaluate_batch_1000', lambda: system.evaluate_batch(batch_probabilities)),
+        ('solve_uniform', lambda: system.solve(uniform_targets)),
+        ('render_streaming', lambda: rendered_board.render_streaming(svg_path)),
+    ]
+    if depth <= MAX_SOLVE_DEPTH:
+        stages.append(('solve', lambda: system.solve(skewed_targets, jac=True)))
+    if depth <= MAX_RENDER_DEPTH:
+        stages.append(('render', lambda: rendered_board.render(svg_path)))
+    if depth <= MAX_PATH_DEPTH:
+        path_system = board.resolve_to_path_system()
+        stages.append(('resolve_to_path_system', board.resolve_to_path_system))
+        stages.append(('path_evaluate', lambda: path_system.evaluate(left_probabilities)))
+
+    return stages
+
+
+def _measure(stage, repeats):
+    """
+    :return: the best wall time over repeats, and the peak traced memory of a separate run (tracing slows things down,
+    so the two are not measured together)
+    """
+    best_seconds = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        stage()
+        best_seconds = min(best_seconds, time.perf_counter() - start)
+
+    tracemalloc.start()
+    stage()
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return best_seconds, peak_bytes
+
+
+def run(depths, repeats):
+    """
+    :return: a dict of depth (as a string, for json) to stage name to timing and memory results
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as output_directory:
+        for depth in depths:
+            depth_results = {}
+            for stage_name, stage in _stages(depth, output_directory):
+                seconds, peak_bytes = _measure(stage, repeats)
+                depth_results[stage_name] = {'seconds': seconds, 'peak_bytes': peak_bytes}
+                print('depth %d %s: %.6fs, %d peak bytes' % (depth, stage_name, seconds, peak_bytes))
+            results[str(depth)] = depth_results
+
+    return results
+
+
+def find_regressions(results, baseline, threshold, noise_floor_seconds):
+    """
+    :param threshold: the fractional slowdown (or memory growth) over baseline tolerated before flagging a stage
+    :param noise_floor_seconds: timings below this in both runs are too noisy to compare, and are not flagged
+    :return: a list of strings describing stages that regressed against baseline
+    """
+    regressions = []
+    for depth, depth_results in results.items():
+        for stage_name, stage_results in depth_results.items():
+            baseline_results = baseline.get(depth, {}).get(stage_name)
+            if not baseline_results:
+                continue
+
+            if stage_results['seconds'] > noise_floor_seconds and \
+                    stage_results['seconds'] > baseline_results['seconds'] * (1 + threshold):
+                regressions.append('depth %s %s: %.6fs vs %.6fs baseline' %
+                                   (depth, stage_name, stage_results['seconds'], baseline_results['seconds']))
+            if stage_results['peak_bytes'] > baseline_results['peak_bytes'] * (1 + threshold):
+                regressions.append('depth %s %s: %d vs %d baseline peak bytes' %
+                                   (depth, stage_name, stage_results['peak_bytes'], baseline_results['peak_bytes']))
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Times each stage of the uniform Plinko engine across board depths')
+    parser.add_argument('--depths', type=int, nargs='+', default=DEFAULT_DEPTHS)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', default='./benchmark_results.json')
+    parser.add_argument('--baseline', help='a previous results file to check for regressions against')
+    parser.add_argument('--threshold', type=float, default=.25)
+    parser.add_argument('--noise-floor', type=float, default=.001)
+    args = parser.parse_args()
+
+    results = run(args.depths, args.repeats)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.threshold, args.noise_floor)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,76 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from uniform_plinko import Board
+
+
+def _drop_balls(depth, left_probabilities, number_of_balls, seed_sequence):
+    """
+    drops every ball through the board at once, stepping all of them down a level at a time
+
+    :return: an array of the number of balls landing in each bucket, ordered left to right
+    """
+    rng = np.random.default_rng(seed_sequence)
+    # a ball's position is its offset from the leftmost peg of the level it is currently on
+    positions = np.zeros(number_of_balls, dtype=np.int64)
+    for level in range(depth):
+        first_peg_ix = level * (level + 1) // 2
+        falls_right = rng.random(number_of_balls) >= left_probabilities[first_peg_ix + positions]
+        positions += falls_right
+
+    return np.bincount(positions, minlength=depth + 1)
+
+
+def _drop_chunk(args):
+    return _drop_balls(*args)
+
+
+def simulate(board, number_of_balls, seed=None, processes=1, chunk_size=10**6):
+    """
+    :param board: a Board with left turn probabilities set
+    :param number_of_balls: the total number of balls to drop from the top peg
+    :param seed: seeds the random streams. the balls are dropped in chunks, each with an independent stream spawned
+    from this seed, so results for a given seed do not depend on the number of processes
+    :param processes: the number of worker processes to drop chunks in. 1 drops them in this process
+    :param chunk_size: the maximum number of balls held in memory (per process) at once
+    :return: an array of the number of balls landing in each bucket, ordered as Board.get_bucket_indices
+    """
+    left_probabilities = board.get_left_probabilities()
+    if left_probabilities is None:
+        raise ValueError('Board has no left turn probabilities set to simulate with')
+    left_probabilities = np.asarray(left_probabilities, dtype=float)
+    depth = board.get_depth()
+
+    chunk_sizes = [chunk_size] * (number_of_balls // chunk_size)
+    if number_of_balls % chunk_size:
+        chunk_sizes.append(number_of_balls % chunk_size)
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+    chunks = [(depth, left_probabilities, size, seed_sequence)
+              for size, seed_sequence in zip(chunk_sizes, seed_sequences)]
+
+    bucket_counts = np.zeros(depth + 1, dtype=np.int64)
+    if processes == 1:
+        for chunk in chunks:
+            bucket_counts += _drop_chunk(chunk)
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            for chunk_counts in executor.map(_drop_chunk, chunks):
+                bucket_counts += chunk_counts
+
+    return bucket_counts
+
+
+if __name__ == '__main__':
+    board = Board(10)
+    system = board.resolve_to_system()
+    bucket_indices = board.get_bucket_indices()
+    peg_left_probabilities = system.solve({ix: 1/len(bucket_indices) for ix in bucket_indices}, jac=True)
+    bucket_probabilities = system.evaluate(peg_left_probabilities)
+    board.set_probabilities(peg_left_probabilities, bucket_probabilities)
+
+    number_of_balls = 10**7
+    bucket_counts = simulate(board, number_of_balls, seed=1, processes=4)
+    for bucket_index, count in zip(bucket_indices, bucket_counts):
+        print('%d: simulated %.4f, evaluated %.4f' % (bucket_index, count / number_of_balls,
+                                                      bucket_probabilities[bucket_index]))
@@ -0,0 +1,176 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from uniform_plinko import Board
+
+
+def _target_array(target_probabilities):
+    """
+    :param target_probabilities: a dict from bucket index to target probability
+    :return: the target probabilities as an array ordered by bucket index
+    """
+    return np.array([target_probabilities[bucket_index] for bucket_index in sorted(target_probabilities)], dtype=float)
+
+
+def _target_hash(targets):
+    # rounded so that the same distribution computed slightly differently (e.g. 1/11 vs 1 - 10/11) hits the same entry
+    return hashlib.sha1(np.round(targets, 12).tobytes()).hexdigest()
+
+
+def _lift(solution, depth):
+    """
+    :param solution: left turn probabilities solving a depth - 1 board
+    :return: starting guesses for a depth board, keeping the solution for the upper levels and splitting the new bottom
+    level 50/50
+    """
+    return list(solution) + [.5 for _ in range(depth)]
+
+
+class SolutionCache:
+    """
+    stores solved left turn probabilities keyed by board depth and target distribution. solutions are persisted to
+    directory as one .npz per entry, with the most recently used entries also held in memory
+    """
+    def __init__(self, directory, max_entries=128):
+        self._directory = directory
+        self._max_entries = max_entries
+        # (depth, target hash) -> (target array, solution array), least recently used first
+        self._entries = OrderedDict()
+        # depth -> {target hash: target array} of every stored entry seen, searched for warm starts without loading
+        # solutions or disturbing the recency of _entries
+        self._depth_to_targets = {}
+
+    def _depth_directory(self, depth):
+        return os.path.join(self._directory, 'depth_%d' % (depth,))
+
+    def _remember(self, key, targets, solution):
+        self._entries[key] = (targets, solution)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def _load(self, depth, target_hash):
+        key = (depth, target_hash)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        file_path = os.path.join(self._depth_directory(depth), target_hash + '.npz')
+        if not os.path.exists(file_path):
+            return None
+
+        with np.load(file_path) as stored:
+            targets, solution = stored['targets'], stored['solution']
+        self._remember(key, targets, solution)
+
+        return targets, solution
+
+    def _stored_hashes(self, depth):
+        depth_directory = self._depth_directory(depth)
+        if not os.path.isdir(depth_directory):
+            return []
+
+        # temporary files (and any left over by an older naming that ended in .tmp.npz) are not entries
+        return [file_name[:-len('.npz')] for file_name in os.listdir(depth_directory)
+                if file_name.endswith('.npz') and '.tmp.' not in file_name]
+
+    def _stored_targets(self, depth):
+        """
+        :return: a dict from target hash to target array for every entry stored at depth. only the targets of entries
+        not seen before are read, e.g. those written by another process
+        """
+        hash_to_targets = self._depth_to_targets.setdefault(depth, {})
+        for target_hash in self._stored_hashes(depth):
+            if target_hash not in hash_to_targets:
+                with np.load(os.path.join(self._depth_directory(depth), target_hash + '.npz')) as stored:
+                    hash_to_targets[target_hash] = stored['targets']
+
+        return hash_to_targets
+
+    def _nearest(self, depth, targets):
+        """
+        :return: the stored solution at depth whose targets are closest (in euclidean distance) to targets, or None
+        """
+        nearest_hash = None
+        nearest_distance = np.inf
+        for target_hash, stored_targets in self._stored_targets(depth).items():
+            distance = np.linalg.norm(stored_targets - targets)
+            if distance < nearest_distance:
+                nearest_hash, nearest_distance = target_hash, distance
+
+        return None if nearest_hash is None else self._load(depth, nearest_hash)[1]
+
+    def get(self, depth, target_probabilities):
+        """
+        :param target_probabilities: a dict from bucket index to target probability
+        :return: the stored list of left turn probabilities for this depth and target, or None if it isn't stored
+        """
+        entry = self._load(depth, _target_hash(_target_array(target_probabilities)))
+        return None if entry is None else list(entry[1])
+
+    def put(self, depth, target_probabilities, solution):
+        targets = _target_array(target_probabilities)
+        target_hash = _target_hash(targets)
+        solution = np.asarray(solution, dtype=float)
+
+        depth_directory = self._depth_directory(depth)
+        os.makedirs(depth_directory, exist_ok=True)
+        # write then rename, so a crash never leaves a partial entry behind. the temporary file is written through a
+        # handle, since np.savez appends .npz to paths, and its suffix keeps it from being listed as an entry
+        temporary_path = os.path.join(depth_directory, target_hash + '.npz.tmp')
+        with open(temporary_path, 'wb') as f:
+            np.savez(f, targets=targets, solution=solution)
+        os.replace(temporary_path, os.path.join(depth_directory, target_hash + '.npz'))
+
+        self._depth_to_targets.setdefault(depth, {})[target_hash] = targets
+        self._remember((depth, target_hash), targets, solution)
+
+    def warm_start(self, depth, target_probabilities):
+        """
+        :return: starting guesses from the nearest stored solution at this depth. failing that, the depth - 1 solution
+        nearest to the target (interpolated down to depth buckets) lifted to this depth. None if neither exists
+        """
+        targets = _target_array(target_probabilities)
+        nearest_solution = self._nearest(depth, targets)
+        if nearest_solution is not None:
+            return list(nearest_solution)
+
+        if depth > 1:
+            shallower_targets = np.interp(np.linspace(0, 1, depth), np.linspace(0, 1, depth + 1), targets)
+            shallower_targets /= shallower_targets.sum()
+            nearest_solution = self._nearest(depth - 1, shallower_targets)
+            if nearest_solution is not None:
+                return _lift(nearest_solution, depth)
+
+        return None
+
+    def solve(self, board, target_probabilities, jac=True):
+        """
+        :param board: the Board to solve
+        :param target_probabilities: a dict from bucket index to target probability
+        :return: a list of left turn probabilities corresponding to each peg, from the cache if it has been solved
+        before, otherwise solved from a warm start and stored
+        """
+        depth = board.get_depth()
+        solution = self.get(depth, target_probabilities)
+        if solution is not None:
+            return solution
+
+        system = board.resolve_to_system()
+        solution = system.solve(target_probabilities, jac=jac,
+                                starting_guesses=self.warm_start(depth, target_probabilities))
+        self.put(depth, target_probabilities, solution)
+
+        return solution
+
+
+if __name__ == '__main__':
+    cache = SolutionCache('./solutions')
+    for depth in range(3, 21):
+        board = Board(depth)
+        bucket_indices = board.get_bucket_indices()
+        cache.solve(board, {ix: 1/len(bucket_indices) for ix in bucket_indices})
+        print('depth %d solved' % (depth,))
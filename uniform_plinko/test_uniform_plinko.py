@@ -0,0 +1,80 @@
+import numpy as np
+
+from simulate import simulate
+from uniform_plinko import Board, solve_uniform
+
+SHALLOW_DEPTHS = [1, 2, 3, 4, 6]
+
+
+def _random_probabilities(board, seed=0):
+    return np.random.default_rng(seed).random(board.get_number_of_pegs())
+
+
+def _skewed_targets(board):
+    bucket_indices = board.get_bucket_indices()
+    weights = np.arange(1, len(bucket_indices) + 1, dtype=float)
+    return dict(zip(bucket_indices, weights / weights.sum()))
+
+
+def test_evaluate_matches_path_enumeration():
+    for depth in SHALLOW_DEPTHS:
+        board = Board(depth)
+        probabilities = _random_probabilities(board, depth)
+        evaluations = board.resolve_to_system().evaluate(probabilities)
+        path_evaluations = board.resolve_to_path_system().evaluate(probabilities)
+
+        assert sorted(evaluations) == sorted(path_evaluations) == board.get_bucket_indices()
+        for bucket_index, probability in path_evaluations.items():
+            assert np.isclose(evaluations[bucket_index], probability, rtol=0, atol=1e-12)
+
+
+def test_gradient_matches_finite_differences():
+    board = Board(6)
+    system = board.resolve_to_system()
+    targets = _skewed_targets(board)
+    probabilities = _random_probabilities(board)
+
+    _, gradient = system._objective_and_gradient(probabilities, targets)
+    step = 1e-6
+    for peg_ix in range(board.get_number_of_pegs()):
+        offset = np.zeros(board.get_number_of_pegs())
+        offset[peg_ix] = step
+        loss_above, _ = system._objective_and_gradient(probabilities + offset, targets)
+        loss_below, _ = system._objective_and_gradient(probabilities - offset, targets)
+        assert np.isclose(gradient[peg_ix], (loss_above - loss_below) / (2 * step), rtol=1e-5, atol=1e-9)
+
+
+def test_evaluate_batch_rows_match_evaluate():
+    board = Board(5)
+    system = board.resolve_to_system()
+    probabilities = np.random.default_rng(0).random((4, board.get_number_of_pegs()))
+
+    bucket_probabilities = system.evaluate_batch(probabilities)
+    assert bucket_probabilities.shape == (4, len(board.get_bucket_indices()))
+    for row, row_probabilities in zip(bucket_probabilities, probabilities):
+        evaluations = system.evaluate(row_probabilities)
+        assert row.tolist() == [evaluations[bucket_index] for bucket_index in board.get_bucket_indices()]
+
+
+def test_solve_uniform_gives_uniform_buckets():
+    for depth in SHALLOW_DEPTHS + [20]:
+        board = Board(depth)
+        system = board.resolve_to_system()
+        evaluations = system.evaluate(solve_uniform(depth))
+        assert np.allclose(list(evaluations.values()), 1 / (depth + 1), rtol=0, atol=1e-12)
+
+        # uniform targets are solved in closed form, even from a warm start
+        uniform_targets = {bucket_index: 1 / (depth + 1) for bucket_index in board.get_bucket_indices()}
+        starting_guesses = [.5 for _ in range(board.get_number_of_pegs())]
+        assert system.solve(uniform_targets, starting_guesses=starting_guesses) == solve_uniform(depth)
+
+
+def test_simulate_is_reproducible_across_processes():
+    board = Board(6)
+    left_probabilities = solve_uniform(6)
+    board.set_probabilities(left_probabilities, board.resolve_to_system().evaluate(left_probabilities))
+
+    bucket_counts = simulate(board, 50000, seed=1, chunk_size=8000)
+    assert bucket_counts.sum() == 50000
+    assert simulate(board, 50000, seed=1, processes=2, chunk_size=8000).tolist() == bucket_counts.tolist()
+    assert simulate(board, 50000, seed=2, chunk_size=8000).tolist() != bucket_counts.tolist()
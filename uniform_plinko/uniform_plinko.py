@@ -1,26 +1,27 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import Manager
+
 import numpy as np
 from scipy.optimize import minimize
 import svgwrite as svg
 
 
-def _generate_plinko_adjacency(depth):
+def _generate_plinko_children(depth):
+    """
+    :return: a (number_of_pegs x 2) array holding the index of the left and right child of each peg. buckets have no
+    children, so they are not present
+    """
     number_of_pegs = int(depth * (depth + 1) / 2)
-    number_of_buckets = depth + 1
-    adjacency = np.zeros([number_of_pegs + number_of_buckets, number_of_pegs + number_of_buckets])
-
-    # note that this can be done more cleanly (by setting 1's at 2 * row_ix + 1 and 2 * row_ix + 2)
-    # but I think this is conceptually clearer
-    total_pegs = 0
-    for level in range(1, depth + 1):
-        # each level is the same length as its depth
-        for parent_peg_ix in range(total_pegs, total_pegs + level):
-            # the to left peg is always offset by the length of the parent row, right length of parent row + 1
-            adjacency[parent_peg_ix, parent_peg_ix + level] = 1
-            adjacency[parent_peg_ix, parent_peg_ix + level + 1] = 1
+    # each level is the same length as its depth
+    peg_levels = np.repeat(np.arange(1, depth + 1), np.arange(1, depth + 1))
+    peg_indices = np.arange(number_of_pegs)
 
-            total_pegs += 1
+    children = np.empty([number_of_pegs, 2], dtype=np.int64)
+    # the to left peg is always offset by the length of the parent row, right length of parent row + 1
+    children[:, 0] = peg_indices + peg_levels
+    children[:, 1] = peg_indices + peg_levels + 1
 
-    return adjacency
+    return children
 
 
 class Path:
@@ -60,7 +61,257 @@ class Path:
         return self.__repr__()
 
 
+def _first_peg_index(level):
+    """
+    :param level: a zero-indexed board level
+    :return: the index of the leftmost peg on the level
+    """
+    return level * (level + 1) // 2
+
+
+def solve_uniform(depth):
+    """
+    constructs left turn probabilities producing the uniform distribution over buckets, without any optimization.
+    the mass is kept uniform at every level: with mass 1 / (l + 1) at each of the l + 1 pegs on level l, having the
+    kth peg fall left with probability (l + 1 - k) / (l + 2) leaves mass 1 / (l + 2) at each position on level l + 1
+
+    :return: a list of left turn probabilities corresponding to each peg
+    """
+    peg_levels = np.repeat(np.arange(depth), np.arange(1, depth + 1))
+    peg_positions = np.arange(int(depth * (depth + 1) / 2)) - peg_levels * (peg_levels + 1) // 2
+
+    return ((peg_levels + 1 - peg_positions) / (peg_levels + 2)).tolist()
+
+
 class PlinkoSystem:
+    """
+    evaluates bucket probabilities by propagating probability mass down the board one level at a time. each peg is
+    visited exactly once, so evaluation is linear in the number of pegs
+    """
+    def __init__(self, depth):
+        self._depth = depth
+        self._number_of_pegs = int(depth * (depth + 1) / 2)
+
+    def _propagate(self, probabilities):
+        """
+        :param probabilities: left turn probabilities corresponding to each peg, optionally stacked along leading
+        dimensions (i.e. shape (..., number_of_pegs))
+        :return: a list of the probability mass arriving at each position, for each level from the root to the buckets
+        """
+        probabilities = np.asarray(probabilities, dtype=float)
+        batch_shape = probabilities.shape[:-1]
+        level_masses = [np.ones(batch_shape + (1,))]
+        for level in range(self._depth):
+            first_peg_ix = _first_peg_index(level)
+            left_probabilities = probabilities[..., first_peg_ix:first_peg_ix + level + 1]
+            mass = level_masses[-1]
+
+            next_mass = np.zeros(batch_shape + (level + 2,))
+            # the left fall from a peg lands at the same position on the next level, the right fall one over
+            next_mass[..., :-1] += mass * left_probabilities
+            next_mass[..., 1:] += mass * (1 - left_probabilities)
+            level_masses.append(next_mass)
+
+        return level_masses
+
+    def evaluate(self, probabilities):
+        """
+        :param probabilities: a list of left turn probabilities corresponding to each peg
+        :return: a dict of bucket_index to the probability of landing in that bucket
+        """
+        bucket_masses = self._propagate(probabilities)[-1]
+        return {self._number_of_pegs + bucket_count: mass for bucket_count, mass in enumerate(bucket_masses.tolist())}
+
+    def evaluate_batch(self, probabilities):
+        """
+        :param probabilities: an (n_vectors x number_of_pegs) array, each row being left turn probabilities for each peg
+        :return: an (n_vectors x number_of_buckets) array of bucket probabilities, columns ordered by bucket index
+        """
+        probabilities = np.asarray(probabilities, dtype=float)
+        if probabilities.ndim != 2 or probabilities.shape[1] != self._number_of_pegs:
+            raise ValueError('Expected an array of shape (n_vectors, %d), got %s' %
+                             (self._number_of_pegs, probabilities.shape))
+
+        return self._propagate(probabilities)[-1]
+
+    def _evaluate_for_roots(self, probabilities, target_probabilities):
+        """
+        :param probabilities: a list of left turn probabilities corresponding to each peg
+        :param target_probabilities: a dict from bucket index to target probability
+        :return: a tuple of evaluated bucket probabilities
+        """
+        evaluations = self.evaluate(probabilities)
+        bucket_outcomes = []
+        for bucket_index in sorted(evaluations.keys()):
+            bucket_outcomes.append(evaluations[bucket_index] - target_probabilities[bucket_index])
+
+        return bucket_outcomes
+
+    def _objective_and_gradient(self, probabilities, target_probabilities):
+        """
+        computes the squared loss on the bucket outcomes with a forward pass, then its exact gradient with respect to
+        every peg with a single backward (adjoint) pass up the board
+
+        :param probabilities: a list of left turn probabilities corresponding to each peg
+        :param target_probabilities: a dict from bucket index to target probability
+        :return: a tuple of the loss and an array of its partial derivatives for each peg
+        """
+        probabilities = np.asarray(probabilities, dtype=float)
+        level_masses = self._propagate(probabilities)
+        targets = np.array([target_probabilities[bucket_index] for bucket_index in sorted(target_probabilities)])
+        residuals = level_masses[-1] - targets
+
+        gradient = np.zeros(self._number_of_pegs)
+        # the adjoint at a position is the derivative of the loss with respect to the mass arriving there
+        adjoint = 2 * residuals
+        for level in reversed(range(self._depth)):
+            first_peg_ix = _first_peg_index(level)
+            left_probabilities = probabilities[first_peg_ix:first_peg_ix + level + 1]
+
+            gradient[first_peg_ix:first_peg_ix + level + 1] = level_masses[level] * (adjoint[:-1] - adjoint[1:])
+            adjoint = left_probabilities * adjoint[:-1] + (1 - left_probabilities) * adjoint[1:]
+
+        return float(np.sum(residuals ** 2)), gradient
+
+    def _minimize(self, target_probabilities, starting_guesses, jac, callback=None):
+        """
+        :param callback: called with the current probabilities after each iteration. an exception it raises ends the
+        optimization, propagating out of this
+        :return: the scipy OptimizeResult of minimizing squared bucket loss from starting_guesses
+        """
+        bounds = [(0, 1) for _ in range(self._number_of_pegs)]
+        if jac:
+            return minimize(self._objective_and_gradient,
+                            starting_guesses,
+                            args=(target_probabilities,),
+                            jac=True,
+                            bounds=bounds,
+                            callback=callback)
+
+        return minimize(lambda x: sum(x**2 for x in self._evaluate_for_roots(x, target_probabilities)),
+                        starting_guesses,
+                        bounds=bounds,
+                        callback=callback)
+
+    def solve(self, target_probabilities, jac=False, starting_guesses=None):
+        """
+        :param target_probabilities: a dict from bucket index to target probability
+        :param jac: if True, supply the optimizer with exact gradients instead of letting it use finite differences
+        :param starting_guesses: left turn probabilities for each peg to start the optimizer from. defaults to .5.
+        uniform targets are solved directly by solve_uniform, whether or not starting guesses are given
+        :return: a list of left turn probabilities corresponding to each peg
+        """
+        if np.allclose(list(target_probabilities.values()), 1 / (self._depth + 1)):
+            return solve_uniform(self._depth)
+        if starting_guesses is None:
+            starting_guesses = [.5 for _ in range(self._number_of_pegs)]
+
+        left_peg_probability_solutions = self._minimize(target_probabilities, starting_guesses, jac)
+        return list(left_peg_probability_solutions.x)
+
+    def solve_multistart(self, target_probabilities, number_of_starts=8, seed=None, tolerance=None, max_workers=None,
+                         jac=True):
+        """
+        solves from number_of_starts uniformly random starting guesses across a process pool, to escape the poor local
+        minima a single start can land in
+
+        :param target_probabilities: a dict from bucket index to target probability
+        :param seed: seeds the starting guesses, which are all drawn up front so they do not depend on scheduling
+        :param tolerance: once any start reaches a loss at or below this, starts that have not yet begun are skipped and
+        running starts are stopped at their next iteration. note that which starts are affected depends on scheduling
+        :param max_workers: the number of worker processes, defaulting to the number of cores
+        :return: a tuple of the lowest loss list of left turn probabilities, and a list of diagnostic dicts per start,
+        noting whether each start was skipped or stopped early
+        """
+        all_starting_guesses = np.random.default_rng(seed).random((number_of_starts, self._number_of_pegs))
+
+        with Manager() as manager, ProcessPoolExecutor(max_workers=max_workers) as executor:
+            stop_event = manager.Event()
+            future_to_start = {executor.submit(_solve_from_start, self, target_probabilities, starting_guesses, jac,
+                                               stop_event): start
+                               for start, starting_guesses in enumerate(all_starting_guesses)}
+
+            start_to_result = {}
+            for future in as_completed(future_to_start):
+                start = future_to_start[future]
+                result = None if future.cancelled() else future.result()
+                start_to_result[start] = result
+
+                if tolerance is not None and result is not None and result['loss'] <= tolerance:
+                    stop_event.set()
+                    for pending_future in future_to_start:
+                        pending_future.cancel()
+
+        diagnostics = []
+        best_start = None
+        for start in range(number_of_starts):
+            result = start_to_result[start]
+            if result is None:
+                diagnostics.append({'start': start, 'skipped': True, 'stopped_early': False, 'loss': None,
+                                    'iterations': None, 'success': None, 'message': None})
+                continue
+
+            diagnostics.append({'start': start, 'skipped': False, 'stopped_early': result['stopped_early'],
+                                'loss': result['loss'], 'iterations': result['iterations'],
+                                'success': result['success'], 'message': result['message']})
+            if best_start is None or result['loss'] < start_to_result[best_start]['loss']:
+                best_start = start
+
+        return start_to_result[best_start]['probabilities'], diagnostics
+
+
+class _StoppedEarly(Exception):
+    """
+    raised from a minimize callback to end a start early. scipy only ends L-BFGS-B cleanly on a callback's
+    StopIteration from 1.11, so the start catches this itself and reports its latest iterate
+    """
+
+
+def _solve_from_start(system, target_probabilities, starting_guesses, jac, stop_event):
+    """
+    a process pool task for PlinkoSystem.solve_multistart
+
+    :return: a dict describing the solution from starting_guesses, or None if another start already hit tolerance.
+    a start still running when another hits tolerance is stopped after its current iteration
+    """
+    if stop_event.is_set():
+        return None
+
+    latest = {'probabilities': np.asarray(starting_guesses, dtype=float), 'iterations': 0}
+
+    def record_or_stop(probabilities):
+        latest['probabilities'] = np.copy(probabilities)
+        latest['iterations'] += 1
+        if stop_event.is_set():
+            raise _StoppedEarly
+
+    try:
+        solution = system._minimize(target_probabilities, starting_guesses, jac, callback=record_or_stop)
+        probabilities, iterations, success = solution.x, solution.nit, bool(solution.success)
+        # older scipy reports L-BFGS-B's message as bytes
+        message = solution.message.decode() if isinstance(solution.message, bytes) else str(solution.message)
+        stopped_early = False
+    except _StoppedEarly:
+        probabilities, iterations = latest['probabilities'], latest['iterations']
+        success, message, stopped_early = False, 'stopped early, as another start reached tolerance', True
+    loss, _ = system._objective_and_gradient(probabilities, target_probabilities)
+
+    return {
+        'probabilities': list(probabilities),
+        'loss': loss,
+        'iterations': iterations,
+        'success': success,
+        'message': message,
+        'stopped_early': stopped_early,
+    }
+
+
+class PathPlinkoSystem:
+    """
+    the original engine, which evaluates buckets by summing products over every enumerated root to bucket path. there
+    are 2^depth paths, so this is only suitable for validating PlinkoSystem on shallow boards. it shares nothing with
+    PlinkoSystem, and solves with finite differences over its own evaluations, so it is an independent check
+    """
     def __init__(self, paths, number_of_pegs):
         # this is paths grouped by the bucket they terminate in
         grouped_paths = {}
@@ -75,7 +326,7 @@ class PlinkoSystem:
     def evaluate(self, probabilities):
         """
         :param probabilities: a list of left turn probabilities corresponding to each peg
-        :return: a dict of bucket_index to
+        :return: a dict of bucket_index to the probability of landing in that bucket
         """
         bucket_index_to_probabilities = {}
         for bucket_index in self._bucket_index_to_paths:
@@ -110,33 +361,45 @@ class PlinkoSystem:
         return list(left_peg_probability_solutions.x)
 
 
-def _traverse(adjacency, current_path):
+def _traverse(children, current_path):
     last_index = current_path.get_last_from_index()
-    traversable_indices = np.nonzero(adjacency[last_index, ])[0]
-    if not len(traversable_indices) == 2:
+    if last_index >= len(children):
         return current_path,
 
-    left_traversal = current_path.append(traversable_indices[0], True)
-    right_traversal = current_path.append(traversable_indices[1], False)
+    left_index, right_index = children[last_index]
+    left_traversal = current_path.append(left_index, True)
+    right_traversal = current_path.append(right_index, False)
 
-    return _traverse(adjacency, left_traversal) + _traverse(adjacency, right_traversal)
+    return _traverse(children, left_traversal) + _traverse(children, right_traversal)
 
 
 class Board:
     def __init__(self, depth):
         self._depth = depth
         self._number_of_pegs = int(depth * (depth + 1) / 2)
-        self._adjacency = _generate_plinko_adjacency(depth)
+        self._children = _generate_plinko_children(depth)
         self._left_probabilities = None
         self._bucket_probabilities = None
 
     def resolve_to_system(self):
-        all_paths = _traverse(self._adjacency, Path((0,)))
-        return PlinkoSystem(all_paths, self._number_of_pegs)
+        return PlinkoSystem(self._depth)
+
+    def resolve_to_path_system(self):
+        """
+        :return: a system backed by full path enumeration, for validating resolve_to_system on shallow boards
+        """
+        all_paths = _traverse(self._children, Path((0,)))
+        return PathPlinkoSystem(all_paths, self._number_of_pegs)
+
+    def get_depth(self):
+        return self._depth
 
     def get_number_of_pegs(self):
         return self._number_of_pegs
 
+    def get_left_probabilities(self):
+        return self._left_probabilities
+
     def set_probabilities(self, peg_left_probabilities, bucket_probabilities):
         self._left_probabilities = peg_left_probabilities
         self._bucket_probabilities = bucket_probabilities
@@ -203,12 +466,8 @@ class Board:
         # render edges between pegs, including transition probabilities
         for from_peg_ix in range(self._number_of_pegs):
             from_peg_center = peg_index_to_center[from_peg_ix]
-            traversable_peg_indices = np.nonzero(self._adjacency[from_peg_ix,])[0]
-
-            left_peg_ix = traversable_peg_indices[0]
+            left_peg_ix, right_peg_ix = self._children[from_peg_ix]
             left_peg_center = peg_index_to_center[left_peg_ix]
-
-            right_peg_ix = traversable_peg_indices[1]
             right_peg_center = peg_index_to_center[right_peg_ix]
 
             doc.add(doc.line(start=(_pf(from_peg_center[0] - peg_radius), _pf(from_peg_center[1] + peg_radius)),
@@ -239,6 +498,104 @@ class Board:
 
         doc.save()
 
+    def render_streaming(self, file_path='/Users/kholub/plinko.svg', lod_depth=40, label_depth=12):
+        """
+        renders the board like render, but writes each element straight to file_path as it is generated rather than
+        building the document in memory. pegs are drawn as references to a single defined peg. on boards deeper than
+        lod_depth, every level but the last is drawn as one row filled with a pattern of a peg and its edges. right
+        turn probabilities are only labelled on the first label_depth levels
+        """
+        number_of_buckets = self._depth + 1
+        bucket_width = 100 / number_of_buckets
+
+        peg_horizontal_spacing = 100 / number_of_buckets
+        peg_vertical_spacing = 90 / self._depth
+        peg_radius = peg_vertical_spacing / 16
+        font_size = min(4, bucket_width / 3)
+
+        line_template = '<line x1="%f" y1="%f" x2="%f" y2="%f" stroke="black" stroke-width="1" ' \
+                        'vector-effect="non-scaling-stroke"/>\n'
+        text_template = '<text x="%f" y="%f" font-size="%f">%s</text>\n'
+
+        def _peg_center(level, peg_count):
+            horizontal_offset_to_first = peg_horizontal_spacing * (number_of_buckets - level) / 2
+            return (horizontal_offset_to_first + peg_count * peg_horizontal_spacing,
+                    level * peg_vertical_spacing + .5 * peg_vertical_spacing)
+
+        def _bucket_edges(bucket_count):
+            return max((1, bucket_count * bucket_width)), min((99, (bucket_count + 1) * bucket_width))
+
+        def _child_center(level, peg_count):
+            if level < self._depth:
+                return _peg_center(level, peg_count)
+            bucket_left_position, bucket_right_position = _bucket_edges(peg_count)
+            return (bucket_right_position + bucket_left_position) / 2, 90
+
+        def _edges(from_center, left_center, right_center):
+            return (line_template % (from_center[0] - peg_radius, from_center[1] + peg_radius,
+                                     left_center[0] + peg_radius, left_center[1] - peg_radius) +
+                    line_template % (from_center[0] + peg_radius, from_center[1] + peg_radius,
+                                     right_center[0] - peg_radius, right_center[1] - peg_radius))
+
+        with open(file_path, 'w') as f:
+            f.write('<?xml version="1.0" encoding="utf-8" ?>\n')
+            f.write('<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+                    'width="100%" height="100%" viewBox="0 0 100 100">\n')
+
+            f.write('<defs>\n')
+            f.write('<circle id="peg" cx="0" cy="0" r="%f" stroke="black" stroke-width="1" '
+                    'vector-effect="non-scaling-stroke" fill="rgb(66, 206, 183)"/>\n' % (peg_radius,))
+            # a single peg with its edges down to the next level, tiled across a row
+            f.write('<pattern id="peg-row" patternUnits="userSpaceOnUse" width="%f" height="%f">\n' %
+                    (peg_horizontal_spacing, 2 * peg_vertical_spacing))
+            f.write('<use xlink:href="#peg" x="%f" y="%f"/>\n' % (peg_horizontal_spacing / 2, peg_vertical_spacing / 2))
+            f.write(_edges((peg_horizontal_spacing / 2, peg_vertical_spacing / 2),
+                           (0, 1.5 * peg_vertical_spacing),
+                           (peg_horizontal_spacing, 1.5 * peg_vertical_spacing)))
+            f.write('</pattern>\n')
+            f.write('</defs>\n')
+
+            # render pegs and the edges below them, including transition probabilities
+            for level in range(self._depth):
+                if self._depth > lod_depth and level < self._depth - 1:
+                    first_peg_center = _peg_center(level, 0)
+                    f.write('<rect x="0" y="0" width="%f" height="%f" fill="url(#peg-row)" '
+                            'transform="translate(%f, %f)"/>\n' %
+                            ((level + 1) * peg_horizontal_spacing, 2 * peg_vertical_spacing,
+                             first_peg_center[0] - peg_horizontal_spacing / 2,
+                             first_peg_center[1] - peg_vertical_spacing / 2))
+                else:
+                    for peg_count in range(level + 1):
+                        from_peg_center = _peg_center(level, peg_count)
+                        f.write('<use xlink:href="#peg" x="%f" y="%f"/>\n' % from_peg_center)
+                        f.write(_edges(from_peg_center,
+                                       _child_center(level + 1, peg_count),
+                                       _child_center(level + 1, peg_count + 1)))
+
+                if self._left_probabilities and level < label_depth:
+                    for peg_count in range(level + 1):
+                        from_peg_center = _peg_center(level, peg_count)
+                        right_peg_center = _child_center(level + 1, peg_count + 1)
+                        right_peg_probability = 1 - self._left_probabilities[_first_peg_index(level) + peg_count]
+                        f.write(text_template % ((right_peg_center[0] + from_peg_center[0]) / 2,
+                                                 (right_peg_center[1] + from_peg_center[1]) / 2,
+                                                 font_size / 2,
+                                                 "%.2f" % right_peg_probability))
+
+            # render buckets, including bucket probabilities
+            bucket_top = 90 + peg_radius - .25 * peg_vertical_spacing
+            for bucket_count, bucket_index in enumerate(self.get_bucket_indices()):
+                bucket_left_position, bucket_right_position = _bucket_edges(bucket_count)
+                f.write(line_template % (bucket_left_position, bucket_top, bucket_left_position, 100))
+                f.write(line_template % (bucket_right_position, bucket_top, bucket_right_position, 100))
+
+                if self._bucket_probabilities:
+                    horizontal_position = (bucket_right_position + bucket_left_position) / 2 - bucket_width / 4
+                    probability = self._bucket_probabilities[bucket_index]
+                    f.write(text_template % (horizontal_position, 95, font_size, "%.1f%%" % (probability * 100)))
+
+            f.write('</svg>\n')
+
 if __name__ == '__main__':
     board = Board(10)
     system = board.resolve_to_system()